@@ -0,0 +1,78 @@
+"""Random DAGs, and their patterns, for the randomized PC tests.
+
+The tests import the PC code from src/causal_inference/test_my_pc.py. Run
+them from any directory as 'python pc_tests/test_xxx.py [seed]'.
+"""
+import os, sys
+from itertools import combinations, product
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "../src/causal_inference/"))
+import matplotlib
+matplotlib.use('Agg')
+
+from test_my_pc import CompactGraph
+
+def random_dag(random_state, n_nodes, edge_prob):
+    """Return the arcs of a random DAG over 0..n_nodes-1.
+
+    Every pair of nodes is adjacent with probability edge_prob, and the arcs
+    follow a random topological order.
+    """
+    order = random_state.permutation(n_nodes).tolist()
+    return [ (order[i], order[j])
+             for i, j in combinations(xrange(n_nodes), 2)
+             if random_state.rand() < edge_prob ]
+
+def find_v_structures(arcs):
+    """Return the set of v-structures (a, c, b), with a < b, of a DAG's arcs.
+    """
+    adjacent = set(arcs) | set((b, a) for a, b in arcs)
+    parents = {}
+    for a, b in arcs: parents.setdefault(b, []).append(a)
+    v_structures = set()
+    for c, c_parents in parents.iteritems():
+        for a, b in combinations(sorted(c_parents), 2):
+            if (a, b) not in adjacent: v_structures.add((a, c, b))
+    return v_structures
+
+def build_pattern(n_nodes, arcs):
+    """Return the skeleton of the DAG as a CompactGraph, with only its
+    v-structures oriented.
+    """
+    G = CompactGraph(range(n_nodes))
+    for a, b in arcs: G.add_edge(a, b)
+    for a, c, b in find_v_structures(arcs):
+        G.remove_arc(c, a)
+        G.remove_arc(c, b)
+    return G
+
+def find_undirected_edges(G):
+    return [(a, b) for a, b in G.edges() if G.is_undirected(a, b)]
+
+def iter_orientations(G):
+    """Yield the arcs of every graph made by orienting each undirected edge
+    of G one way or the other (G's directed arcs are kept).
+    """
+    undirected = find_undirected_edges(G)
+    directed = [(a, b) for a, b in G.arcs() if not G.has_edge(b, a)]
+    for flips in product((False, True), repeat=len(undirected)):
+        yield directed + [ (b, a) if flip else (a, b)
+                           for (a, b), flip in zip(undirected, flips) ]
+    return
+
+def is_acyclic(n_nodes, arcs):
+    G = CompactGraph(range(n_nodes))
+    for a, b in arcs: G.add_arc(a, b)
+    return G.is_acyclic()
+
+def brute_force_equivalence_class(n_nodes, arcs):
+    """Return the DAGs (as frozensets of arcs) that are Markov equivalent to
+    the DAG arcs - the acyclic orientations of its skeleton with the same
+    v-structures.
+    """
+    v_structures = find_v_structures(arcs)
+    return set( frozenset(dag)
+                for dag in iter_orientations(build_pattern(n_nodes, arcs))
+                if is_acyclic(n_nodes, dag)
+                and find_v_structures(dag) == v_structures )
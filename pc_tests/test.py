@@ -1,7 +1,6 @@
 import os, sys, signal
 
 import multiprocessing
-from multiprocessing.sharedctypes import Value, Array
 
 import numpy
 
@@ -12,39 +11,20 @@ from sklearn import preprocessing
 
 import networkx as nx
 
-NTHREADS = 12
-
-class ThreadSafeFile( file ):
-    def __init__( *args ):
-        file.__init__( *args )
-        args[0].lock = multiprocessing.Lock()
-
-    def write( self, string ):
-        with self.lock:
-            file.write( self, string )
-            self.flush()
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "../src/causal_inference/"))
+from test_my_pc import (
+    NeighborhoodSelector, iter_neighborhood_selections, load_expression_matrix)
 
+NTHREADS = 12
 
 rep1_cols = numpy.array((0,2,4))
 rep2_cols = numpy.array((1,3,5))
-def cv_gen():
-    yield rep1_cols, rep2_cols
-    yield rep2_cols, rep1_cols
-    return
 
 
 def load_data():
-    samples = None
-    genes = []
-    expression = numpy.zeros((103501, 10), dtype=float)
-    with open("all_quant.txt") as fp:
-        for i, line in enumerate(fp):
-            data = line.split()
-            if i == 0:
-               samples = data[1:]
-               continue
-            genes.append(data[0])
-            expression[i-1,:] = map(float, data[1:])
+    # every gene is kept - the callers filter by total expression
+    samples, genes, expression = load_expression_matrix("all_quant.txt", None)
     
     #res = numpy.zeros((103501, 103501))
     #cov = graph_lasso(expression.dot(expression.T), 100)
@@ -54,76 +34,83 @@ def load_data():
     cov = None
     return samples, genes, expression[:,(3,4,0,2,5,7)], cov
 
-def estimate_covariates(pred_expression, resp_expression, i):
-    #if ( pred_expression[i,(0,2,4)].sum() < 1 #1e-12 
-    #     or pred_expression[i,(1,3,5)].sum() < 1): # 1e-12):
-    #    nonzero_coefs = []
-    #    alpha = 0
-    #else:
-    response = resp_expression[i,:]
-    pred_expression[i,:] = 0
-    clf = linear_model.LassoCV(
-       fit_intercept=False, cv=cv_gen(), verbose=0, n_jobs=1)
-    clf.fit(pred_expression.T, response.T)
-    alpha = clf.alpha_
-    nonzero_coefs = numpy.nonzero(numpy.abs(clf.coef_) > 1e-12)[0].tolist()
-    
-    return alpha, nonzero_coefs
-
 def fit_regression_models(expression, expression_indices):
-    pred_expression = expression[:,(0,1,2,3,4,5)]
-    resp_expression = expression[:,(0,1,2,3,4,5)]
-    
-    shared_index = Value('i', 0)
-    pids = []
-    with ThreadSafeFile("output_noshift.txt", "w") as ofp:
-        for p_index in xrange(NTHREADS):
-            pid = os.fork()
-            if pid == 0:
-                while True:
-                    with shared_index.get_lock():
-                        i = shared_index.value
-                        if i >= len(expression): break
-                        shared_index.value += 1
-                    alpha, nonzero_coefs = estimate_covariates(
-                        pred_expression, resp_expression, i)
-                    output_str = "{}\t{}\t{}\n".format(
-                        expression_indices[i], alpha, 
-                        "\t".join(str(expression_indices[x]) 
-                                  for x in nonzero_coefs))
-                    print output_str,
-                    ofp.write(output_str)
-                sys._exit()
-            else:
-                pids.append(pid)
-        try:
-            for pid in pids:
-                os.waitpid(pid, 0)
-        except:
-            for pid in pids:
-                os.kill(pid, signal.SIGTERM)
-            raise
-
-def build_graph(edge_fname, expression, genes):
-    G = nx.Graph()
-    for node_id, gene in enumerate(genes):
-        G.add_node(node_id, gene_id=genes[node_id], alpha=0.0)
-    
-    # add all of the node alphas and all edges
+    # the replicates are the cross validation folds, and every other gene is
+    # a predictor (marginal_alpha=1 disables the marginal filter)
+    selector = NeighborhoodSelector(
+        expression[:,rep1_cols], expression[:,rep2_cols], marginal_alpha=1.0)
+    with open("output_noshift.txt", "w") as ofp:
+        for i, alpha, nonzero_coefs, coefs in iter_neighborhood_selections(
+                selector, xrange(len(expression)), NTHREADS):
+            output_str = "{}\t{}\t{}\n".format(
+                expression_indices[i], alpha, 
+                "\t".join(str(expression_indices[x]) 
+                          for x in nonzero_coefs))
+            print output_str,
+            ofp.write(output_str)
+            ofp.flush()
+
+def load_edge_file(edge_fname):
+    """Parse an edge file written by fit_regression_models.
+
+    Returns (node_ids, alphas, src, dst) arrays - the node and alpha of 
+    every line, and an edge from the node to every target on its line.
+    """
+    node_ids, alphas, targets = [], [], []
     with open(edge_fname) as fp:
         for line in fp:
-            data = line.split()
-            node_id = int(data[0])
-            alpha = float(data[1])
-            G.node[node_id]['alpha'] = alpha
-            for edge_target in (int(x) for x in data[2:]):
-                G.add_edge(node_id, edge_target)
+            data = line.split(None, 2)
+            node_ids.append(int(data[0]))
+            alphas.append(float(data[1]))
+            targets.append(
+                numpy.fromstring(data[2], dtype=int, sep=' ') 
+                if len(data) > 2 else numpy.zeros(0, dtype=int))
+    node_ids = numpy.array(node_ids, dtype=int)
+    src = numpy.repeat(node_ids, [len(x) for x in targets])
+    dst = numpy.concatenate(targets) if len(targets) > 0 else src.copy()
+    return node_ids, numpy.array(alphas, dtype=float), src, dst
+
+def find_connected_components(n_nodes, src, dst):
+    """Return the component of every node, labeled by its smallest node.
+
+    This is a union-find over arrays - every round hooks the larger root of
+    each edge that joins two trees onto the smaller one, and then flattens 
+    the trees by pointer jumping.
+    """
+    parent = numpy.arange(n_nodes)
+    while True:
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all(): break
+            parent = grandparent
+        src_root, dst_root = parent[src], parent[dst]
+        joining = src_root != dst_root
+        if not joining.any(): 
+            return parent
+        numpy.minimum.at(
+            parent, 
+            numpy.maximum(src_root[joining], dst_root[joining]),
+            numpy.minimum(src_root[joining], dst_root[joining]))
+
+def build_graph(edge_fname, expression, genes, min_component_size=11):
+    node_ids, alphas, src, dst = load_edge_file(edge_fname)
+    n_nodes = max([len(genes), node_ids.max()+1 if len(node_ids) > 0 else 0,
+                   max(src.max(), dst.max())+1 if len(src) > 0 else 0])
+    node_alphas = numpy.zeros(n_nodes, dtype=float)
+    node_alphas[node_ids] = alphas
     
-
-    for x in nx.connected_component_subgraphs(G):
-        if len(x.nodes()) <= 10:
-            for node in x.nodes():
-                G.remove_node(node)
+    # only build the graph from the nodes in large enough components
+    components = find_connected_components(n_nodes, src, dst)
+    keep = numpy.bincount(components)[components] >= min_component_size
+    G = nx.Graph()
+    for node_id in keep.nonzero()[0].tolist():
+        if node_id < len(genes):
+            G.add_node(node_id, gene_id=genes[node_id], 
+                       alpha=node_alphas[node_id])
+        else:
+            G.add_node(node_id)
+    kept_edges = keep[src]
+    G.add_edges_from(zip(src[kept_edges].tolist(), dst[kept_edges].tolist()))
     return G
 
 def main():
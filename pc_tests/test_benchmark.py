@@ -0,0 +1,36 @@
+"""Check that the benchmark's simulated replicates are recoverable.
+
+On an easy configuration (a small tree, strong parent-child correlations and
+30 timepoints per replicate), benchmark_pc.run_config must recover some of
+the simulated graph's edges - replicates that don't share their timepoints
+have no O0 edges at all.
+
+Usage: python test_benchmark.py [seed [n_trials]]
+"""
+import sys
+
+# sets up the path to test_my_pc
+import random_graphs
+import test_my_pc
+import benchmark_pc
+
+def test_benchmark_recall(seed=0, n_trials=3):
+    test_my_pc.VERBOSE = False
+    recalls = []
+    for trial in xrange(n_trials):
+        result = benchmark_pc.run_config(
+            depth=2, n_children=2, n_samples=30, max_order=8, corr=0.9,
+            alpha=0.01, n_threads=2, seed=seed+trial, ci_test='partial_corr')
+        assert result['skeleton_recall'] > 0, result
+        recalls.append(result['skeleton_recall'])
+    return recalls
+
+def main():
+    seed = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    n_trials = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    recalls = test_benchmark_recall(seed, n_trials)
+    print "Skeleton recall: %s" % ", ".join("%.2f" % x for x in recalls)
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Compare the chain component DAG counting and enumeration to brute force.
+
+For random DAGs, the CPDAG (the pattern closed under the IC rules) is
+decomposed with find_chain_components, and count_consistent_dags and
+iter_consistent_dags are checked against the equivalence class found by
+enumerating every orientation of the undirected edges.
+
+Usage: python test_chain_components.py [seed [n_trials]]
+"""
+import sys
+
+import numpy
+import networkx as nx
+
+from random_graphs import (
+    random_dag, build_pattern, find_undirected_edges,
+    brute_force_equivalence_class )
+from test_my_pc import (
+    propagate_orientations, find_chain_components, count_consistent_dags,
+    iter_consistent_dags )
+
+def check_dag(n_nodes, arcs):
+    cpdag = build_pattern(n_nodes, arcs)
+    propagate_orientations(cpdag)
+
+    undirected = nx.Graph(find_undirected_edges(cpdag))
+    expected_components = sorted(
+        sorted(x) for x in nx.connected_components(undirected))
+    assert sorted(find_chain_components(cpdag)) == expected_components
+
+    expected_dags = brute_force_equivalence_class(n_nodes, arcs)
+    assert frozenset(arcs) in expected_dags
+    assert count_consistent_dags(cpdag) == len(expected_dags), (
+        arcs, count_consistent_dags(cpdag), len(expected_dags))
+    dags = [frozenset(dag.arcs()) for dag in iter_consistent_dags(cpdag)]
+    assert len(dags) == len(set(dags))
+    assert set(dags) == expected_dags, arcs
+    return len(expected_dags)
+
+# the brute force enumerates 2**n orientations of the pattern's undirected
+# edges, so draw DAGs with at most this many
+MAX_UNDIRECTED_EDGES = 14
+
+def test_chain_components(seed=0, n_trials=300):
+    random_state = numpy.random.RandomState(seed)
+    n_checked = 0
+    while n_checked < n_trials:
+        n_nodes = random_state.randint(1, 9)
+        arcs = random_dag(random_state, n_nodes, random_state.uniform(0.2, 0.8))
+        if len(find_undirected_edges(build_pattern(n_nodes, arcs))) \
+                > MAX_UNDIRECTED_EDGES: 
+            continue
+        check_dag(n_nodes, arcs)
+        n_checked += 1
+    return
+
+def main():
+    seed = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    n_trials = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    test_chain_components(seed, n_trials)
+    print "Checked %i random DAGs" % n_trials
+    return
+
+if __name__ == '__main__':
+    main()
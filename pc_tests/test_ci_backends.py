@@ -0,0 +1,98 @@
+"""Compare the partial correlation CI test to the lstsq regression test.
+
+For random expression matrices and skeletons, every edge is tested at
+orders 1-3 (with and without ORDER_CI_SUBSETS, and with and without an
+n_samples override) by test_for_CI_partial_corr and test_for_CI_lstsq, which
+must return the same separating set (or both None). The same comparison is
+run on matrices with 4-7 columns at every order that the PC search reaches,
+up to n_samples-2.
+
+Usage: python test_ci_backends.py [seed [n_trials]]
+"""
+import sys
+from itertools import combinations
+
+import numpy
+
+# sets up the path to test_my_pc
+import random_graphs
+# (test_for_CI isn't imported by name, so that pytest doesn't collect it)
+import test_my_pc
+from test_my_pc import CSRSkeleton
+
+def random_skeleton(random_state, n_nodes, edge_prob):
+    edges = numpy.array(
+        [ (a, b) for a, b in combinations(xrange(n_nodes), 2)
+          if random_state.rand() < edge_prob ], dtype='int32').reshape(-1, 2)
+    return CSRSkeleton.from_edge_arrays(
+        range(n_nodes), edges[:,0], edges[:,1],
+        corr=random_state.uniform(-1, 1, len(edges)),
+        marginal_p=random_state.uniform(0, 0.05, len(edges)))
+
+def compare_backends(random_state, n_nodes, n_samples, orders):
+    """Check that both backends agree on every edge of a random skeleton, at
+    every order in orders. Returns the numbers of tests and of independent
+    pairs.
+    """
+    n_tests = n_independent = 0
+    # correlated columns, so that both outcomes are common
+    mixing = random_state.normal(size=(n_nodes, n_nodes))
+    mixing *= random_state.rand(n_nodes, n_nodes) < 0.4
+    data = ( numpy.eye(n_nodes) + mixing ).dot(
+        random_state.normal(size=(n_nodes, n_samples)))
+    G = random_skeleton(random_state, n_nodes, random_state.uniform(0.4, 1))
+    alpha = random_state.choice((0.01, 0.05, 0.2))
+    # the stability replicates' p-values use fewer samples than columns
+    n_eff = random_state.choice((None, n_samples//2 + 3))
+    for n1, n2 in G.edges():
+        for order in orders:
+            for order_subsets in (False, True):
+                expected = test_my_pc.test_for_CI(
+                    G, n1, n2, data, order, alpha, 'lstsq', 
+                    order_subsets, n_eff)
+                result = test_my_pc.test_for_CI(
+                    G, n1, n2, data, order, alpha, 'partial_corr',
+                    order_subsets, n_eff)
+                assert result == expected, (
+                    n_samples, n1, n2, order, order_subsets, result, expected)
+                n_tests += 1
+                n_independent += (expected is not None)
+    return n_tests, n_independent
+
+def test_ci_backends(seed=0, n_trials=100):
+    random_state = numpy.random.RandomState(seed)
+    n_tests = n_independent = 0
+    for trial in xrange(n_trials):
+        trial_tests, trial_independent = compare_backends(
+            random_state, random_state.randint(4, 10), 
+            random_state.randint(8, 30), (1, 2, 3))
+        n_tests += trial_tests
+        n_independent += trial_independent
+    return n_tests, n_independent
+
+def test_ci_backends_few_samples(seed=0, n_trials=100):
+    """The PC orders reach n_samples-2, where the correlation sub-matrices
+    are singular (and partial_corr falls back to lstsq).
+    """
+    random_state = numpy.random.RandomState(seed)
+    n_tests = n_independent = 0
+    for trial in xrange(n_trials):
+        n_samples = random_state.randint(4, 8)
+        trial_tests, trial_independent = compare_backends(
+            random_state, random_state.randint(6, 10), n_samples, 
+            range(1, n_samples-1))
+        n_tests += trial_tests
+        n_independent += trial_independent
+    return n_tests, n_independent
+
+def main():
+    seed = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    n_trials = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    for test_fn in (test_ci_backends, test_ci_backends_few_samples):
+        n_tests, n_independent = test_fn(seed, n_trials)
+        print "%s: %i CI tests agreed (%i independent)" % (
+            test_fn.__name__, n_tests, n_independent)
+    return
+
+if __name__ == '__main__':
+    main()
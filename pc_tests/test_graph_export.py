@@ -0,0 +1,81 @@
+"""Round trip random graphs through write_graph and export_graph.
+
+Every graph, with both directed and undirected edges and float edge
+attributes, is written as a binary edge list, exported to each supported
+format (GML and GEXF), and read back with networkx. The labels, arcs and
+attribute values (under their GML keys for GML) must survive.
+
+Usage: python test_graph_export.py [seed [n_trials]]
+"""
+import os, sys
+import shutil
+import tempfile
+
+import numpy
+import networkx as nx
+
+from random_graphs import random_dag
+from test_my_pc import CompactGraph, write_graph, export_graph, gml_key
+
+ATTR_NAMES = ('corr', 'marginal_p', 'selection_frequency')
+
+def random_graph(random_state, n_nodes):
+    """Return a CompactGraph with the skeleton of a random DAG, some of
+    whose arcs are left undirected, and random edge attributes.
+    """
+    G = CompactGraph(["gene_%i" % i for i in xrange(n_nodes)])
+    for a, b in random_dag(random_state, n_nodes, 0.5):
+        G.add_edge(a, b, **dict((name, float(random_state.rand()))
+                                for name in ATTR_NAMES))
+        if random_state.rand() < 0.5: G.remove_arc(b, a)
+    return G
+
+def read_export(fname):
+    """Return the arcs, as label pairs, and their attributes of an exported
+    graph.
+    """
+    if fname.endswith(".gexf"):
+        G = nx.read_gexf(fname, relabel=True)
+        names = dict((name, name) for name in ATTR_NAMES)
+    else:
+        G = nx.read_gml(fname, label='label')
+        names = dict((name, gml_key(name)) for name in ATTR_NAMES)
+    return dict(((str(a), str(b)),
+                 dict((name, float(data[key]))
+                      for name, key in names.iteritems()))
+                for a, b, data in G.edges(data=True))
+
+def test_graph_export(seed=0, n_trials=20):
+    random_state = numpy.random.RandomState(seed)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for trial in xrange(n_trials):
+            G = random_graph(random_state, random_state.randint(2, 12))
+            expected = dict(
+                ((G.labels[a], G.labels[b]),
+                 G.edge_data[(min(a, b), max(a, b))])
+                for a, b in G.arcs())
+            fname = os.path.join(tmp_dir, "graph.npz")
+            write_graph(fname, G)
+            for ext in (".gml", ".gexf"):
+                ofname = os.path.join(tmp_dir, "graph" + ext)
+                export_graph(fname, ofname)
+                observed = read_export(ofname)
+                assert sorted(observed) == sorted(expected), (ext, trial)
+                for arc, data in expected.iteritems():
+                    for name in ATTR_NAMES:
+                        assert abs(observed[arc][name] - data[name]) < 1e-9, (
+                            ext, arc, name)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return
+
+def main():
+    seed = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    n_trials = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    test_graph_export(seed, n_trials)
+    print "Round tripped %i graphs through GML and GEXF" % n_trials
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Compare the worklist IC rule propagation to the naive fixed point.
+
+For random DAGs, the pattern (optionally with some of the DAG's other arcs
+oriented as background knowledge) is closed with propagate_orientations, and
+with a reference loop that re-applies every rule, in both directions, to
+every undirected edge until nothing changes. Both closures must agree, and
+the CPDAG's directed arcs must be exactly the arcs shared by every DAG in
+the (brute force) equivalence class.
+
+Usage: python test_meek_rules.py [seed [n_trials]]
+"""
+import sys
+
+import numpy
+
+from random_graphs import (
+    random_dag, build_pattern, find_undirected_edges,
+    brute_force_equivalence_class )
+from test_my_pc import IC_RULES, propagate_orientations
+
+# see test_chain_components.MAX_UNDIRECTED_EDGES
+MAX_UNDIRECTED_EDGES = 14
+
+def naive_propagate_orientations(G):
+    """Apply the IC rules to every undirected edge, in both directions,
+    until no more edges can be oriented.
+    """
+    while True:
+        for a, b in find_undirected_edges(G):
+            if any(rule(a, b, G) for rule in IC_RULES):
+                G.remove_arc(b, a)
+                break
+            if any(rule(b, a, G) for rule in IC_RULES):
+                G.remove_arc(a, b)
+                break
+        else:
+            return
+
+def check_closure(G):
+    expected = G.copy()
+    naive_propagate_orientations(expected)
+    propagate_orientations(G)
+    assert sorted(G.arcs()) == sorted(expected.arcs())
+    return G
+
+def test_meek_rules(seed=0, n_trials=300):
+    random_state = numpy.random.RandomState(seed)
+    n_checked = 0
+    while n_checked < n_trials:
+        n_nodes = random_state.randint(1, 10)
+        arcs = random_dag(random_state, n_nodes, random_state.uniform(0.2, 0.8))
+        pattern = build_pattern(n_nodes, arcs)
+        if len(find_undirected_edges(pattern)) > MAX_UNDIRECTED_EDGES:
+            continue
+
+        cpdag = check_closure(pattern.copy())
+        dags = brute_force_equivalence_class(n_nodes, arcs)
+        directed = set(
+            (a, b) for a, b in cpdag.arcs() if not cpdag.has_edge(b, a))
+        assert directed == frozenset.intersection(*dags), arcs
+
+        # orient some of the DAG's arcs as background knowledge
+        for a, b in arcs:
+            if pattern.is_undirected(a, b) and random_state.rand() < 0.3:
+                pattern.remove_arc(b, a)
+        check_closure(pattern)
+        n_checked += 1
+    return
+
+def main():
+    seed = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    n_trials = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    test_meek_rules(seed, n_trials)
+    print "Checked %i random DAGs" % n_trials
+    return
+
+if __name__ == '__main__':
+    main()
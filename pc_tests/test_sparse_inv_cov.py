@@ -4,13 +4,24 @@ import multiprocessing
 from multiprocessing.sharedctypes import Value, Array
 
 import numpy
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
 
-from sklearn.covariance import GraphLasso, GraphLassoCV
+from sklearn.covariance import (
+    GraphicalLasso, GraphicalLassoCV, graphical_lasso )
 from sklearn import linear_model
 from sklearn.cross_validation import KFold
 from sklearn import preprocessing
 
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "../src/causal_inference/"))
+from test_my_pc import run_forked_workers
+
 NTHREADS = 24
+# number of genes in each tile of the thresholded covariance screen
+COV_BLOCK_SIZE = 1024
+# the largest connected component that the blockwise graphical lasso solves
+MAX_GLASSO_BLOCK_SIZE = 5000
 
 class ThreadSafeFile( file ):
     def __init__( *args ):
@@ -68,6 +79,104 @@ def estimate_covariates(pred_expression, resp_expression, i):
     
     return alpha, nonzero_coefs
 
+def find_thresholded_covariance_edges(
+        centered, alpha, block_size=COV_BLOCK_SIZE):
+    """Return the (rows, cols) of the empirical covariance entries i < j 
+    with |S_ij| > alpha.
+
+    centered is the genes x samples matrix with every gene centered. S is 
+    computed one tile at a time, so the full genes x genes matrix is never
+    stored.
+    """
+    n_genes, n_samples = centered.shape
+    rows, cols = [numpy.zeros(0, dtype=int)], [numpy.zeros(0, dtype=int)]
+    for i_start in xrange(0, n_genes, block_size):
+        i_stop = min(i_start+block_size, n_genes)
+        for j_start in xrange(i_start, n_genes, block_size):
+            j_stop = min(j_start+block_size, n_genes)
+            cov = centered[i_start:i_stop].dot(
+                centered[j_start:j_stop].T)/n_samples
+            sig = numpy.abs(cov) > alpha
+            # only keep the upper triangle 
+            if j_start == i_start:
+                sig &= ( numpy.arange(j_start, j_stop)[None,:] 
+                         > numpy.arange(i_start, i_stop)[:,None] )
+            block_rows, block_cols = sig.nonzero()
+            rows.append(block_rows + i_start)
+            cols.append(block_cols + j_start)
+    return numpy.concatenate(rows), numpy.concatenate(cols)
+
+def find_covariance_blocks(centered, alpha):
+    """Return the genes in each connected component of the graph with an 
+    edge wherever |S_ij| > alpha, largest component first.
+
+    The graphical lasso solution at alpha is block diagonal over these 
+    components (Witten et al. 2011, Mazumder and Hastie 2012), so every 
+    block can be solved on its own.
+    """
+    n_genes = len(centered)
+    rows, cols = find_thresholded_covariance_edges(centered, alpha)
+    adjacency = scipy.sparse.coo_matrix(
+        (numpy.ones(len(rows), dtype=bool), (rows, cols)), 
+        shape=(n_genes, n_genes))
+    n_components, labels = connected_components(adjacency, directed=False)
+    order = numpy.argsort(labels, kind='mergesort')
+    boundaries = numpy.searchsorted(
+        labels[order], numpy.arange(n_components+1))
+    blocks = [ order[boundaries[i]:boundaries[i+1]] 
+               for i in xrange(n_components) ]
+    blocks.sort(key=len, reverse=True)
+    return blocks
+
+def fit_covariance_block(centered, alpha, block):
+    """Return the graphical lasso precision matrix of the genes in block."""
+    centered = centered[block]
+    emp_cov = centered.dot(centered.T)/centered.shape[1]
+    _, precision = graphical_lasso(emp_cov, alpha, mode='cd')
+    return precision
+
+def estimate_blockwise_precision(expression, alpha, n_threads=NTHREADS):
+    """Estimate the sparse precision matrix of the genes (rows of expression)
+    by the graphical lasso, solved independently for every block found by 
+    find_covariance_blocks. 
+
+    Singleton blocks have the precision 1/S_ii, and the larger blocks are 
+    solved in parallel by forked workers (run_forked_workers), which 
+    inherit the centered expression matrix. Returns a scipy.sparse CSR 
+    matrix.
+    """
+    centered = expression - expression.mean(1)[:,None]
+    n_genes, n_samples = centered.shape
+    blocks = find_covariance_blocks(centered, alpha)
+    if len(blocks) > 0 and len(blocks[0]) > MAX_GLASSO_BLOCK_SIZE:
+        raise ValueError(
+            "The largest block has %i genes (more than %i) - use a larger alpha"
+            % (len(blocks[0]), MAX_GLASSO_BLOCK_SIZE))
+    print "Found %i blocks (largest %i, %i singletons)" % (
+        len(blocks), len(blocks[0]) if len(blocks) > 0 else 0,
+        sum(1 for block in blocks if len(block) == 1))
+    
+    rows, cols, values = [], [], []
+    singletons = numpy.array(
+        [block[0] for block in blocks if len(block) == 1], dtype=int)
+    with numpy.errstate(divide='ignore'):
+        rows.append(singletons)
+        cols.append(singletons)
+        values.append(n_samples/(centered[singletons]**2).sum(1))
+
+    for block, precision in run_forked_workers(
+            lambda block: fit_covariance_block(centered, alpha, block),
+            [block for block in blocks if len(block) > 1], n_threads):
+        block_rows, block_cols = precision.nonzero()
+        rows.append(block[block_rows])
+        cols.append(block[block_cols])
+        values.append(precision[block_rows, block_cols])
+    
+    return scipy.sparse.coo_matrix(
+        (numpy.concatenate(values), 
+         (numpy.concatenate(rows), numpy.concatenate(cols))),
+        shape=(n_genes, n_genes)).tocsr()
+
 def main():
     sample, genes, raw_expression, cov = load_data()
     expression = raw_expression[raw_expression.min(1) > 100]
@@ -79,11 +188,22 @@ def main():
     expression = expression[:,(3,4,0,2,5,7)]
 
     # log data
-    expression = numpy.log10(expression + 1)[1:100,]
+    expression = numpy.log10(expression + 1)
+    
+    # with an alpha, estimate the precision matrix of every gene blockwise
+    if len(sys.argv) > 1:
+        precision = estimate_blockwise_precision(expression, float(sys.argv[1]))
+        print precision.shape, precision.nnz
+        numpy.savez("sparse_inv_cov.npz", data=precision.data, 
+                    indices=precision.indices, indptr=precision.indptr, 
+                    shape=precision.shape)
+        return
+    
+    expression = expression[1:100,]
     cov = expression.dot(expression.T)
     print cov.shape
-    #mo = GraphLasso(alpha=95, mode='lars', verbose=True) #, cv=KFold(3,2), n_jobs=24)
-    mo = GraphLassoCV(mode='lars', verbose=True, cv=KFold(3,2), n_jobs=24)
+    #mo = GraphicalLasso(alpha=95, mode='lars', verbose=True) #, cv=KFold(3,2), n_jobs=24)
+    mo = GraphicalLassoCV(mode='lars', verbose=True, cv=KFold(3,2), n_jobs=24)
     sparse_cov = mo.fit(cov)
     print( numpy.nonzero(sparse_cov)[0].sum() )
     return
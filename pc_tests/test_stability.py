@@ -0,0 +1,68 @@
+"""Check stability selection on 3 timepoint replicates (like the project's).
+
+The timepoints of 3 timepoint replicates can't be resampled, so
+estimate_stable_skeleton must default to resampling the genes. Every
+selection frequency must be a fraction of the replicates that drew both
+genes, the consensus must be the candidate edges at or above the threshold,
+and some of the simulated graph's edges must be selected.
+
+Usage: python test_stability.py [seed]
+"""
+import sys
+
+import numpy
+
+# sets up the path to test_my_pc
+import random_graphs
+import test_my_pc
+from test_my_pc import (
+    simulate_causal_graph, simulate_data_from_causal_graph,
+    estimate_stable_skeleton )
+
+N_REPLICATES = 20
+
+def simulate_replicates(random_state, real_G, n_tps):
+    labels, expression = simulate_data_from_causal_graph(
+        real_G, n_tps, 0.9, seed=random_state.randint(2**31-1))
+    expression = expression - expression.min() + 1
+    return labels, [ expression + 0.05*random_state.randn(*expression.shape)
+                     for i in xrange(2) ]
+
+def test_stability_three_timepoints(seed=0):
+    test_my_pc.VERBOSE = False
+    random_state = numpy.random.RandomState(seed)
+    real_G = simulate_causal_graph(2, 3)
+    labels, (sample1, sample2) = simulate_replicates(random_state, real_G, 3)
+
+    # resampling the timepoints is rejected
+    for method in ('bootstrap', 'subsample'):
+        try:
+            estimate_stable_skeleton(
+                sample1, sample2, labels, n_replicates=2, method=method)
+        except ValueError:
+            pass
+        else:
+            assert False, method
+
+    consensus, frequencies = estimate_stable_skeleton(
+        sample1, sample2, labels, n_replicates=N_REPLICATES, alpha=0.2,
+        threshold=0.5, n_threads=4, seed=seed)
+    assert len(frequencies) > 0
+    assert ((frequencies >= 0) & (frequencies <= 1)).all()
+    assert consensus.number_of_edges() == (frequencies >= 0.5).sum()
+    for a, b in consensus.edges():
+        assert consensus.edge_attr(a, b, 'selection_frequency') >= 0.5
+    true_edges = set(frozenset(x) for x in real_G.edges())
+    selected = set(frozenset((labels[a], labels[b]))
+                   for a, b in consensus.edges())
+    assert len(selected & true_edges) > 0, (selected, true_edges)
+    return consensus.number_of_edges(), len(selected & true_edges)
+
+def main():
+    seed = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    n_edges, n_true = test_stability_three_timepoints(seed)
+    print "Selected %i edges (%i true) from 3 timepoints" % (n_edges, n_true)
+    return
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,8 @@ import re
 import math
 import numpy
 
+from bisect import bisect_left, bisect_right
+
 from collections import defaultdict
 
 import pysam
@@ -13,6 +15,7 @@ import queue
 from grit.lib.multiprocessing_utils import ProcessSafeOPStream, fork_and_wait
 
 import gzip, io
+import itertools
 
 import pickle
 
@@ -23,6 +26,51 @@ RNASEQ_SORT_INDICES = numpy.array((3,4,1,2,6,7))
 class TFs(pysam.TabixFile):
     pass
 
+class GenomicIntervalIndex():
+    """An overlap index of closed intervals [start, stop] on contigs.
+
+    Every contig's intervals are stored sorted by start, along with the 
+    longest interval length. An interval overlapping [start, stop] must 
+    begin in [start - max_length, stop], so a query is two bisects and a 
+    scan of that range, rather than a scan of every interval.
+    """
+    def __init__(self, intervals):
+        """intervals is an iterable of (contig, start, stop, item) tuples."""
+        contig_intervals = defaultdict(list)
+        for contig, start, stop, item in intervals:
+            contig_intervals[contig].append((start, stop, item))
+        
+        self._starts = {}
+        self._stops = {}
+        self._items = {}
+        self._max_lengths = {}
+        for contig, intervals in contig_intervals.items():
+            # a stable sort, so equal starts keep their input order
+            intervals.sort(key=lambda x: x[0])
+            self._starts[contig] = [x[0] for x in intervals]
+            self._stops[contig] = [x[1] for x in intervals]
+            self._items[contig] = [x[2] for x in intervals]
+            self._max_lengths[contig] = max(x[1] - x[0] for x in intervals)
+
+    @property
+    def contigs(self):
+        return sorted(self._starts)
+
+    def iter_intervals(self, contig):
+        """Iterate over contig's (start, stop, item) tuples, sorted by start.
+        """
+        return zip(self._starts.get(contig, []), self._stops.get(contig, []), 
+                   self._items.get(contig, []))
+
+    def find_overlapping(self, contig, start, stop):
+        """Return the items of the intervals that overlap [start, stop]."""
+        if contig not in self._starts: return []
+        starts, stops = self._starts[contig], self._stops[contig]
+        i_start = bisect_left(starts, start - self._max_lengths[contig])
+        i_stop = bisect_right(starts, stop)
+        items = self._items[contig]
+        return [items[i] for i in range(i_start, i_stop) if stops[i] >= start]
+
 def load_GENCODE_names(fname):
     gene_name_map = defaultdict(list)
     with io.TextIOWrapper(gzip.open(fname, 'rb')) as fp:
@@ -80,6 +128,13 @@ def load_enhancers(tfs):
     
     return enhancers
 
+def build_enhancer_index(enhancers):
+    """Index the merged enhancers returned by load_enhancers."""
+    return GenomicIntervalIndex(
+        (contig, start, stop, (start, stop)) 
+        for contig, intervals in enhancers.items()
+        for start, stop in intervals )
+
 def load_tf_gene_mapping(fname=os.path.join(
         DATA_BASE_DIR, "ENCODE_TFS.target.gene.map.txt")):
     tf_gene_map = defaultdict(list)
@@ -155,6 +210,15 @@ def load_tads(mouse_fname=os.path.join(
         
     return dict(tads)
 
+def build_tad_index(tads):
+    """Index the TADs (the spans between consecutive boundaries) returned by
+    load_tads.
+    """
+    return GenomicIntervalIndex(
+        (contig, int(start), int(stop), (int(start), int(stop)))
+        for contig, bndries in tads.items()
+        for start, stop in zip(bndries[:-1], bndries[1:]) )
+
 def load_tf_genes():
     try:
         with open('pickled_genes.obj', 'rb') as fp:
@@ -193,6 +257,92 @@ def load_tf_genes():
 
     return all_genes
 
+def build_tf_gene_index(tf_genes):
+    """Index the genes returned by load_tf_genes - the items are the genes'
+    ensembl ids.
+    """
+    return GenomicIntervalIndex(
+        (gene[0], gene[1], gene[2], gene[4]) for gene in tf_genes)
+
+BEDGRAPH_RUN_DTYPE = numpy.dtype(
+    [('start', numpy.int32), ('end', numpy.int32), ('value', numpy.float32)])
+BEDGRAPH_PARSE_CHUNK_SIZE = 1000000
+
+class BedGraphCoverage():
+    """The signal of a tabix indexed bedGraph, as run length arrays.
+
+    A contig's records are parsed by numpy, a chunk of lines at a time, the 
+    first time the contig is queried, into sorted (starts, ends, values) 
+    arrays plus the cumulative sum of the values. Only the last queried 
+    contig is kept, since the TADs are processed in contig order.
+
+    Each run costs 20 bytes (int32 start and end, float32 value and float64
+    cumulative value), and every worker holds one contig per sample - e.g.
+    a 20M run contig is ~400MB per sample, per worker - so size the number
+    of workers to the largest contig.
+    """
+    def __init__(self, fname):
+        self.tabix = pysam.TabixFile(fname)
+        self._contig = None
+        self._runs = None
+
+    def load_contig(self, contig):
+        """Return contig's (starts, ends, values, cumulative values) arrays.
+        """
+        if contig == self._contig: return self._runs
+        # drop the previous contig before parsing the next one
+        self._contig, self._runs = None, None
+        chunks = []
+        if contig in self.tabix.contigs:
+            lines = self.tabix.fetch(contig)
+            while True:
+                chunk = list(itertools.islice(lines, BEDGRAPH_PARSE_CHUNK_SIZE))
+                if len(chunk) == 0: break
+                chunks.append(numpy.loadtxt(
+                    chunk, dtype=BEDGRAPH_RUN_DTYPE, usecols=(1,2,3), ndmin=1))
+        runs = numpy.concatenate(chunks) if len(chunks) > 0 else numpy.zeros(
+            0, dtype=BEDGRAPH_RUN_DTYPE)
+        starts = runs['start'].copy()
+        ends = runs['end'].copy()
+        values = runs['value'].copy()
+        del runs, chunks
+        cum_values = numpy.concatenate(
+            ((0.0,), numpy.cumsum(values, dtype=float)))
+        self._contig = contig
+        self._runs = (starts, ends, values, cum_values)
+        return self._runs
+
+    def find_overlapping_runs(self, contig, start, stop):
+        """Return the range [i_start, i_stop) of the runs that overlap the 
+        half open region [start, stop) (the records tabix would fetch).
+        """
+        starts, ends, values, cum_values = self.load_contig(contig)
+        i_start = numpy.searchsorted(ends, start, side='right')
+        i_stop = numpy.searchsorted(starts, stop, side='left')
+        return i_start, max(i_start, i_stop)
+
+    def region_sum(self, contig, start, stop):
+        """Return the sum of the values of the runs overlapping the region.
+        """
+        starts, ends, values, cum_values = self.load_contig(contig)
+        i_start, i_stop = self.find_overlapping_runs(contig, start, stop)
+        return cum_values[i_stop] - cum_values[i_start]
+
+    def coverage(self, contig, start, stop):
+        """Return the per base signal of [start, stop) (zero between runs).
+        """
+        starts, ends, values, cum_values = self.load_contig(contig)
+        i_start, i_stop = self.find_overlapping_runs(contig, start, stop)
+        positions = numpy.arange(start, stop)
+        # the last run starting at or before each position
+        run_indices = numpy.searchsorted(
+            starts[i_start:i_stop], positions, side='right') - 1 + i_start
+        covered = run_indices >= i_start
+        covered[covered] = positions[covered] < ends[run_indices[covered]]
+        rv = numpy.zeros(stop-start, dtype=float)
+        rv[covered] = values[run_indices[covered]]
+        return rv
+
 class ATACSeq():
     def __init__(self):
         base = "/data/heterokaryon/ATAC-Seq/wigs/hg19_mm9/"
@@ -208,22 +358,17 @@ class ATACSeq():
         self.all_signal_coverage = []
         for sample_prefix in sample_prefixes:
             fname = os.path.join(base, sample_prefix) + ".bedgraph.gz"
-            self.all_signal_coverage.append(pysam.TabixFile(fname))
+            self.all_signal_coverage.append(BedGraphCoverage(fname))
 
     def extract_signal_in_region(self, contig, start, stop):
-        rv = []
-        for signal_cov in self.all_signal_coverage:
-            res = signal_cov.fetch(contig, start, stop)
-            rv.append( sum( float(x.split()[-1]) for x in res ) )
-        return numpy.array(rv)
+        return numpy.array([ signal_cov.region_sum(contig, start, stop) 
+                             for signal_cov in self.all_signal_coverage ])
 
     def build_signal_coverage_array(self, contig, start, stop):
         rv = numpy.zeros(
             (len(self.all_signal_coverage), stop-start), dtype=float)
         for i, signal_cov in enumerate(self.all_signal_coverage):
-            res = signal_cov.fetch(contig, start, stop)
-            for contig, r_start, r_stop, signal in (x.split() for x in res):
-                rv[i, int(r_start)-start:int(r_stop)-start] = float(signal)
+            rv[i,:] = signal_cov.coverage(contig, start, stop)
         return rv
 
 def tf_bs_parser(line):
@@ -245,11 +390,9 @@ def cov_change(exp):
     return z1, z2
 
 def find_active_enhancers_in_tad(contig, tad_start, tad_stop, 
-                                 tfs, tf_genes, all_atacseq,
+                                 tfs, tf_gene_index, all_atacseq,
                                  hg19_enhancers_ofp, mm9_enhancers_ofp):
-    local_genes = [gene[4] for gene in tf_genes
-                   if gene[0] == contig
-                   and not( gene[2] < tad_start or gene[1] > tad_stop )]
+    local_genes = tf_gene_index.find_overlapping(contig, tad_start, tad_stop)
     #if len(local_genes) == 0: return
     #print( contig, tad_start, tad_stop, file=sys.stderr )
 
@@ -306,7 +449,7 @@ def find_active_enhancers_in_tad(contig, tad_start, tad_stop,
 def worker( tads_queue, hg19_enhancers_ofp, mm9_enhancers_ofp):
     tfs = TFs(os.path.join(DATA_BASE_DIR, "ENCODE_TFS.bed.gz"))
     exp_header, expression = load_expression()
-    tf_genes = load_tf_genes()
+    tf_gene_index = build_tf_gene_index(load_tf_genes())
     all_atacseq = ATACSeq()
     initial_size = tads_queue.qsize()
     while tads_queue.qsize() > 0:
@@ -317,7 +460,7 @@ def worker( tads_queue, hg19_enhancers_ofp, mm9_enhancers_ofp):
         print( tads_queue.qsize(), initial_size, file=sys.stderr )
         find_active_enhancers_in_tad(
             contig, tad_start, tad_stop,
-            tfs, tf_genes, all_atacseq,
+            tfs, tf_gene_index, all_atacseq,
             hg19_enhancers_ofp, mm9_enhancers_ofp)
 
     os._exit(0)
@@ -0,0 +1,230 @@
+"""Benchmark the PC pipeline on simulated causal graphs.
+
+Sweeps the graph size (depth x n_children), the number of samples per
+replicate and MAX_ORDER. Every configuration is run in a forked process, so
+that the reported peak RSS belongs to that run alone. For each run the time
+of every stage (O0 skeleton, each CI order, v-structure orientation and the
+IC rules), the peak RSS, and the structural accuracy against the simulated
+graph are written as one JSON object per line.
+
+Usage: python benchmark_pc.py --depths 2 3 --n-children 2 3 -o results.jsonl
+"""
+import os, sys
+
+import argparse
+import itertools
+import json
+import resource
+import subprocess
+import time
+
+import multiprocessing
+
+import numpy
+
+import test_my_pc
+from test_my_pc import (
+    simulate_causal_graph, simulate_data_from_causal_graph, normalize_samples,
+    estimate_initial_skeleton, PCWorkerPool, apply_pc_order,
+    orient_v_structures, propagate_orientations )
+
+# the sd of the measurement noise added to each replicate (the simulated 
+# expression has unit variance roots)
+REPLICATE_NOISE = 0.1
+
+def find_git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def score_pdag(pdag, real_G):
+    """Compare the estimated pdag's structure against the true DAG.
+
+    Returns the adjacency precision/recall, and the fraction of the true
+    adjacencies that were oriented correctly, oriented incorrectly and left
+    undirected.
+    """
+    true_arcs = set(real_G.edges())
+    true_adjacencies = set(frozenset(x) for x in true_arcs)
+    est_arcs = set((pdag.labels[a], pdag.labels[b]) for a, b in pdag.arcs())
+    est_adjacencies = set(frozenset(x) for x in est_arcs)
+
+    n_true_positives = len(true_adjacencies & est_adjacencies)
+    n_correct, n_reversed, n_undirected = 0, 0, 0
+    for a, b in true_arcs:
+        if frozenset((a, b)) not in est_adjacencies: continue
+        if (a, b) in est_arcs and (b, a) in est_arcs: n_undirected += 1
+        elif (a, b) in est_arcs: n_correct += 1
+        else: n_reversed += 1
+
+    return {
+        'n_true_edges': len(true_adjacencies),
+        'n_estimated_edges': len(est_adjacencies),
+        'skeleton_precision': (
+            float(n_true_positives)/len(est_adjacencies)
+            if len(est_adjacencies) > 0 else None),
+        'skeleton_recall': (
+            float(n_true_positives)/len(true_adjacencies)
+            if len(true_adjacencies) > 0 else None),
+        'n_correctly_oriented': n_correct,
+        'n_reverse_oriented': n_reversed,
+        'n_unoriented': n_undirected
+    }
+
+def simulate_replicates(real_G, n_samples, corr, replicate_noise):
+    """Simulate two replicates of the same n_samples timepoints.
+
+    The O0 skeleton correlates the replicates timepoint by timepoint, so 
+    both are measurements of one simulated expression matrix, each with 
+    independent gaussian noise (sd replicate_noise). The expression is 
+    shifted to be positive, as normalize_samples expects.
+    """
+    labels, expression = simulate_data_from_causal_graph(
+        real_G, n_samples, corr)
+    expression = expression - expression.min() + 1
+    sample1, sample2 = [
+        expression + replicate_noise*numpy.random.randn(*expression.shape)
+        for i in xrange(2) ]
+    return labels, sample1, sample2
+
+def run_config(depth, n_children, n_samples, max_order, corr, alpha,
+               n_threads, seed, ci_test, replicate_noise=REPLICATE_NOISE):
+    """Run the PC pipeline on one simulated data set, timing every stage.
+    """
+    numpy.random.seed(seed)
+    real_G = simulate_causal_graph(depth, n_children)
+    labels, sample1, sample2 = simulate_replicates(
+        real_G, n_samples, corr, replicate_noise)
+
+    stage_times = []
+    def time_stage(name, start_time):
+        stage_times.append((name, time.time() - start_time))
+
+    start_time = time.time()
+    normalized_data = normalize_samples(sample1, sample2)
+    skeleton = estimate_initial_skeleton(
+        normalized_data, labels, alpha,
+        rep1=numpy.arange(n_samples), rep2=numpy.arange(n_samples, 2*n_samples),
+        n_threads=n_threads)
+    time_stage('O0', start_time)
+
+    cond_independence_sets = {}
+    edges_removed = {}
+    pool = PCWorkerPool(
+        normalized_data, skeleton, n_threads=n_threads, ci_test=ci_test)
+    try:
+        for ind_order in xrange(
+                1, min(max_order, min(normalized_data.shape)-2+1)):
+            start_time = time.time()
+            edges_removed['O%i' % ind_order] = apply_pc_order(
+                skeleton, pool, ind_order, alpha, cond_independence_sets)
+            time_stage('O%i' % ind_order, start_time)
+    except:
+        pool.close(terminate=True)
+        raise
+    else:
+        pool.close()
+
+    pdag = skeleton.to_compact_graph()
+    start_time = time.time()
+    orient_v_structures(pdag, cond_independence_sets)
+    time_stage('v_structures', start_time)
+    start_time = time.time()
+    propagate_orientations(pdag)
+    time_stage('IC_rules', start_time)
+
+    result = {
+        'n_nodes': len(labels),
+        'stage_times': dict(stage_times),
+        'total_time': sum(x[1] for x in stage_times),
+        'edges_removed': edges_removed,
+        # ru_maxrss is in KB on linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_worker_rss_kb': resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss
+    }
+    result.update(score_pdag(pdag, real_G))
+    return result
+
+def run_config_in_subprocess(*args):
+    """Run run_config in a forked process, and return its result."""
+    result_queue = multiprocessing.Queue()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            result_queue.put(run_config(*args))
+        except Exception, inst:
+            result_queue.put({'error': repr(inst)})
+        finally:
+            result_queue.close()
+            result_queue.join_thread()
+            os._exit(0)
+    try:
+        result = result_queue.get()
+    finally:
+        os.waitpid(pid, 0)
+    return result
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the PC pipeline on simulated causal graphs.')
+    parser.add_argument('--depths', type=int, nargs='+', default=[2, 3])
+    parser.add_argument('--n-children', type=int, nargs='+', default=[2, 3])
+    parser.add_argument('--n-samples', type=int, nargs='+', default=[3, 10],
+        help='The number of samples in each replicate group.')
+    parser.add_argument('--max-orders', type=int, nargs='+',
+        default=[test_my_pc.MAX_ORDER])
+    parser.add_argument('--corr', type=float, default=0.5)
+    parser.add_argument('--replicate-noise', type=float, 
+        default=REPLICATE_NOISE,
+        help='The sd of the measurement noise added to each replicate.')
+    parser.add_argument('--alpha', type=float, default=test_my_pc.ALPHA)
+    parser.add_argument('--threads', type=int, default=test_my_pc.N_THREADS)
+    parser.add_argument('--ci-tests', nargs='+', default=[test_my_pc.CI_TEST],
+        choices=sorted(test_my_pc.CI_TESTS))
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', '-o', default='pc_benchmark.jsonl')
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    test_my_pc.VERBOSE = False
+    revision = find_git_revision()
+    with open(args.output, "a") as ofp:
+        for (depth, n_children, n_samples, max_order, ci_test, 
+             repeat) in itertools.product(
+                args.depths, args.n_children, args.n_samples, 
+                args.max_orders, args.ci_tests, xrange(args.repeats)):
+            seed = args.seed + repeat
+            result = run_config_in_subprocess(
+                depth, n_children, n_samples, max_order,
+                args.corr, args.alpha, args.threads, seed, ci_test,
+                args.replicate_noise)
+            result.update({
+                'timestamp': time.time(),
+                'git_revision': revision,
+                'ci_test': ci_test,
+                'stable': test_my_pc.STABLE_PC,
+                'order_ci_subsets': test_my_pc.ORDER_CI_SUBSETS,
+                'depth': depth,
+                'n_children': n_children,
+                'n_samples': n_samples,
+                'max_order': max_order,
+                'corr': args.corr,
+                'replicate_noise': args.replicate_noise,
+                'alpha': args.alpha,
+                'threads': args.threads,
+                'seed': seed
+            })
+            print >> sys.stderr, json.dumps(result)
+            ofp.write(json.dumps(result, sort_keys=True) + "\n")
+            ofp.flush()
+    return
+
+if __name__ == '__main__':
+    main()
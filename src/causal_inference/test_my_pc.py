@@ -1,13 +1,27 @@
 import os, sys
 
+import gc
+import functools
+import hashlib
+import heapq
+import json
+import time
+
 import math
 
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, OrderedDict, deque
+from cStringIO import StringIO
 
-from itertools import combinations
+from itertools import combinations, islice
 
 import multiprocessing
+import multiprocessing.sharedctypes
+import Queue
+import re
+import shutil
 import signal
+import tempfile
+import traceback
 
 import networkx as nx
 import matplotlib.pyplot as plt
@@ -19,14 +33,24 @@ import numpy
 from numpy.linalg import pinv
 
 import numpy as np
-from scipy import stats, linalg
+from scipy import stats, linalg, special
+import scipy.sparse
+import scipy.sparse.linalg
 
 from sklearn import linear_model, preprocessing
 from sklearn.feature_selection import f_regression
 from scipy.linalg import lstsq
 from scipy.stats import f, norm, pearsonr
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 N_THREADS = 32
+# seconds to wait for a forked worker's result before checking that the
+# workers are still alive
+WORKER_POLL_INTERVAL = 10.0
 
 #print numpy.random.seed()
 try: 
@@ -45,6 +69,121 @@ ALPHA = 0.01
 MAX_ORDER = 8
 MIN_TPM = 2
 
+# the columns of the merged sample matrix that belong to each replicate group
+REP1_COLS = numpy.array((0,1,2))
+REP2_COLS = numpy.array((3,4,5))
+# number of rows/columns in each tile of the marginal correlation matrix
+MARGINAL_CORR_BLOCK_SIZE = 1024
+# the record type of the edges streamed to disk by the O0 workers
+O0_EDGE_DTYPE = numpy.dtype([
+    ('src', '<i4'), ('dst', '<i4'), ('corr', '<f4'), ('marginal_p', '<f4')])
+
+# the conditional independence test used by test_for_CI - 'partial_corr',
+# 'fisher_z' or 'lstsq' (see CI_TESTS)
+CI_TEST = 'partial_corr'
+# number of conditioning sets whose partial correlations are computed at once
+CI_TEST_BATCH_SIZE = 10000
+# test the conditioning sets made of the common neighbors most strongly 
+# associated with both nodes first, and stop at the first independent set
+ORDER_CI_SUBSETS = False
+# run the order independent 'stable' PC algorithm - every node of an order is
+# tested against the skeleton from the start of that order
+STABLE_PC = False
+# binary checkpoint written after every PC order
+PC_CHECKPOINT_FNAME = "skeleton_O%i.ckpt.npz"
+# binary edge list of the skeleton written after every PC order
+SKELETON_FNAME = "skeleton_O%i.graph.npz"
+# compress the binary edge lists (with zstd, if zstandard is installed)
+COMPRESS_GRAPHS = False
+# the alpha grid of each neighborhood selection response - LASSO_N_ALPHAS 
+# log spaced alphas down to LASSO_EPS times the response's largest 
+LASSO_N_ALPHAS = 100
+LASSO_EPS = 1e-4
+# number of responses sent to a neighborhood selection worker at once
+NEIGHBORHOOD_BATCH_SIZE = 100
+# the fraction of the stability selection replicates that must select an 
+# edge for it to be in the consensus skeleton
+STABILITY_THRESHOLD = 0.6
+# the fraction of the genes drawn by each 'genes' stability replicate
+STABILITY_GENE_FRACTION = 0.5
+# directory of the binary caches of the filtered expression matrix 
+EXPRESSION_CACHE_DIR = "expression_cache"
+
+# callbacks that receive the PC instrumentation events (see record_pc_event)
+PC_EVENT_CALLBACKS = []
+# per process counts of the CI tests, and the conditioning sets they evaluate
+CI_TEST_COUNTERS = defaultdict(int)
+
+def record_pc_event(event, **data):
+    """Send an instrumentation event to every callback in PC_EVENT_CALLBACKS.
+
+    Callbacks are called with a dict containing the event name, the time, 
+    and the event data.
+    """
+    data['event'] = event
+    data['time'] = time.time()
+    for callback in PC_EVENT_CALLBACKS:
+        callback(data)
+    return
+
+def print_pc_event(data):
+    """Print an instrumentation event as a progress message if VERBOSE."""
+    if not VERBOSE: return
+    event = data['event']
+    if event == 'O0_start':
+        print "Estimating marginal independence relationships"
+    elif event == 'O0_block':
+        print "O0: Finished processing %i/%i nodes" % (
+            data['n_processed_nodes'], data['n_nodes'])
+    elif event == 'O0':
+        print "O0: Found %i edges in %.1f sec" % (
+            data['n_edges'], data['elapsed'])
+    elif event == 'pc_order_start':
+        print "O%i: Processing %i clusters: %i nodes" % (
+            data['order'], data['n_clusters'], data['n_nodes'])
+    elif event == 'pc_cluster':
+        print "O%i: Finished processing cluster %i/%i: %i/%i nodes remain" % (
+            data['order'], data['cluster']+1, data['n_clusters'],
+            data['n_remaining_nodes'], data['n_nodes'])
+    elif event == 'pc_order':
+        print "O%i: Removed %i edges (%i remain) with %i CI tests in %.1f sec" % (
+            data['order'], data['n_removed_edges'], data['n_edges'],
+            data['ci_tests'], data['elapsed'])
+    elif event == 'pc_node':
+        print "Test O%i: %i/%i %i remain (%i removed)" % (
+            data['order'], data['node'], data['n_nodes'],
+            data['n_neighbors'] - data['n_removed_edges'], 
+            data['n_removed_edges'])
+    elif event == 'checkpoint':
+        print "Writing O%i skeleton to disk" % data['order']
+    elif event == 'resume':
+        print "Resuming from checkpoint '%s'" % data['fname']
+    elif event == 'v_structures':
+        if data['n_conflicts'] > 0:
+            print "Leaving %i edges with conflicting v-structures unoriented" % (
+                data['n_conflicts'])
+    elif event == 'stability_replicate':
+        print "Stability replicate %i/%i: %i edges in %.1f sec" % (
+            data['n_finished'], data['n_replicates'], data['n_edges'],
+            data['elapsed'])
+    else:
+        print json.dumps(data, sort_keys=True)
+    return
+
+PC_EVENT_CALLBACKS.append(print_pc_event)
+
+class JSONLinesEventWriter(object):
+    """A PC event callback that writes every event as a JSON line.
+
+    e.g. PC_EVENT_CALLBACKS.append(JSONLinesEventWriter(open(fname, "w")))
+    """
+    def __init__(self, ofp):
+        self.ofp = ofp
+
+    def __call__(self, data):
+        self.ofp.write(json.dumps(data, sort_keys=True) + "\n")
+        self.ofp.flush()
+
 def partial_corr(C):
     inv_cov = pinv(numpy.cov(C))
     normalization_mat = numpy.sqrt(
@@ -80,78 +219,329 @@ def simulate_causal_graph(depth, n_children):
     return build_causal_graph(n_children, depth)
 
 
-def simulate_data_from_causal_graph(G, n_timepoints, corr=0.9):
-    # find all nodes without successors
-    assert nx.is_directed_acyclic_graph(G)
-    nodes_stack = [node for node in G.nodes() 
-                   if len(G.predecessors(node)) == 0]
-    expression_values = dict(
-        (node, numpy.random.randn(n_timepoints)) 
-        for node in nodes_stack )
-    
-    # deal with the successors
-    while len(nodes_stack) > 0:
-        parent = nodes_stack.pop()
-        for child in G.successors(parent):
-            val = ( (1-corr)*numpy.random.randn(n_timepoints) 
-                    + corr*expression_values[parent] )
-            val = val/len(G.predecessors(child))
-            if child not in expression_values:
-                expression_values[child] = val
-            else:
-                expression_values[child] += val
-            nodes_stack.append(child)
-
-    return ( sorted(expression_values), 
-             numpy.vstack(y for x, y in sorted(expression_values.items())))
+def simulate_batches_from_causal_graph(
+        G, n_timepoints, corr=0.9, n_batches=1, seed=None):
+    """Simulate n_batches expression matrices from the causal DAG G.
 
-def estimate_covariates(sample1, sample2, resp_index, alpha=0.50):
-    def cv_gen():
-        n_tps = sample1.shape[1]
-        yield range(n_tps), range(n_tps, 2*n_tps)
-        yield range(n_tps, 2*n_tps), range(n_tps)
-        return
+    Every node is a linear function of its parents - 
+        X_c = sum_p (corr*X_p + (1-corr)*e_p)/n_parents(c)
+    and root nodes are standard normal. In matrix form this is 
+    X = W X + E, so all of the samples are simulated with a single sparse 
+    triangular solve X = (I - W)^-1 E, with the nodes in topological order. 
     
-    merged_samples = numpy.hstack((sample1, sample2))
-    # normalize to sum 1
-    merged_samples = ((merged_samples.T)/(merged_samples.sum(1))).T
-
-    pred_mask = numpy.ones(merged_samples.shape[0], dtype=bool)
-    pred_mask[resp_index] = False
+    The noise for batch i is drawn from a RandomState seeded with the i'th 
+    seed drawn from seed (or from numpy.random if seed is None), so a batch 
+    doesn't depend on the number of batches simulated along with it.
 
-    # filter marginally uncorrelated covariates
-    response = merged_samples[resp_index,:]    
-    best_i, min_pval = None, 10
-    for i, row in enumerate(merged_samples):
-        if i == resp_index: continue
-        corr_coef, p_value = pearsonr(row, response)
-        if p_value > alpha: pred_mask[i] = False
-        if p_value < min_pval: best_i = i
-    pred_mask[best_i] = True
+    Returns the sorted node labels, and a list with an 
+    (n_nodes x n_timepoints) matrix for each batch.
+    """
+    assert nx.is_directed_acyclic_graph(G)
+    labels = sorted(G.nodes())
+    topological_order = list(nx.topological_sort(G))
+    index = dict((node, i) for i, node in enumerate(topological_order))
+    n_nodes = len(topological_order)
     
-    clf = linear_model.LassoCV(
-       fit_intercept=True, cv=cv_gen(), verbose=0, max_iter=100000)
-    clf.fit(merged_samples[pred_mask,:].T, response.T)
+    rows, cols, vals = [], [], []
+    noise_sd = numpy.ones(n_nodes, dtype=float)
+    for node in topological_order:
+        parents = list(G.predecessors(node))
+        if len(parents) == 0: continue
+        # the sum of n_parents independent (1-corr)/n_parents noise terms
+        noise_sd[index[node]] = (1-corr)/math.sqrt(len(parents))
+        for parent in parents:
+            rows.append(index[node])
+            cols.append(index[parent])
+            vals.append(-corr/len(parents))
+    # I - W, which is lower triangular in topological order
+    I_minus_W = scipy.sparse.csr_matrix(
+        (numpy.hstack((numpy.ones(n_nodes), vals)),
+         (numpy.hstack((numpy.arange(n_nodes), rows)), 
+          numpy.hstack((numpy.arange(n_nodes), cols)))),
+        shape=(n_nodes, n_nodes))
     
-    alpha = clf.alpha_
+    seed_rng = numpy.random if seed is None else numpy.random.RandomState(seed)
+    batch_seeds = seed_rng.randint(0, 2**31-1, size=n_batches)
+    noise = numpy.hstack([
+        numpy.random.RandomState(batch_seed).randn(n_nodes, n_timepoints)
+        for batch_seed in batch_seeds ])
+    noise *= noise_sd[:,None]
+    expression = scipy.sparse.linalg.spsolve_triangular(
+        I_minus_W, noise, lower=True)
+    expression = expression.reshape((n_nodes, n_batches*n_timepoints))
     
-    clf = linear_model.Lasso(
-       alpha=alpha, max_iter=100000)
-    clf.fit(merged_samples[pred_mask,:].T, response.T)
+    # put the rows back into sorted label order
+    expression = expression[numpy.array([index[x] for x in labels]),:]
+    return labels, [ expression[:,i*n_timepoints:(i+1)*n_timepoints] 
+                     for i in xrange(n_batches) ]
+
+def simulate_data_from_causal_graph(G, n_timepoints, corr=0.9, seed=None):
+    labels, (expression,) = simulate_batches_from_causal_graph(
+        G, n_timepoints, corr, n_batches=1, seed=seed)
+    return labels, expression
+
+def fork_worker(worker_fn, *args):
+    """Fork a process that runs worker_fn(*args) and then exits.
+
+    The child shares (copy-on-write) everything the parent has allocated, 
+    including shared_array memory. If worker_fn raises, the traceback is 
+    printed and the child exits with status 1. Returns the child's pid.
+    """
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 0
+        try: 
+            worker_fn(*args)
+        except:
+            traceback.print_exc()
+            exit_code = 1
+        finally: 
+            os._exit(exit_code)
+    return pid
+
+def stop_workers(pids, terminate=False):
+    """Wait for the forked workers to exit, killing them first if terminate 
+    is set. Workers that have already been reaped are skipped.
+    """
+    if terminate:
+        for pid in pids:
+            try: os.kill(pid, signal.SIGTERM)
+            except OSError: pass
+    for pid in pids:
+        try: os.waitpid(pid, 0)
+        except OSError: pass
+    return
 
-    coefs = clf.coef_.tolist()
-    for i in sorted(int(x) for x in (1-pred_mask).nonzero()[0]):
-        coefs.insert(i, 0)
-    return alpha, coefs
+def get_worker_result(result_queue, pids, timeout=WORKER_POLL_INTERVAL):
+    """Return the next result from the forked workers pids.
 
+    The queue is polled every timeout seconds, and a RuntimeError is raised
+    if any worker has exited (e.g. killed by the OOM killer) - its result
+    would never arrive.
+    """
+    while True:
+        try:
+            return result_queue.get(timeout=timeout)
+        except Queue.Empty:
+            pass
+        for pid in pids:
+            try: dead_pid, status = os.waitpid(pid, os.WNOHANG)
+            except OSError: dead_pid, status = pid, None
+            if dead_pid == 0: continue
+            if status is not None and os.WIFSIGNALED(status):
+                reason = "was killed by signal %i" % os.WTERMSIG(status)
+            elif status is not None:
+                reason = "exited with status %i" % os.WEXITSTATUS(status)
+            else:
+                reason = "has already been reaped"
+            raise RuntimeError("Forked worker %i %s" % (pid, reason))
 
-def estimate_skeleton_from_samples(sample1, sample2, labels, thresh_ratio=1000):
+def _forked_task_worker(worker_fn, task_queue, result_queue):
+    while True:
+        task = task_queue.get()
+        # every task has been run
+        if task is None: break
+        task_i, task = task
+        try:
+            result_queue.put((task_i, worker_fn(task), None))
+        except Exception:
+            result_queue.put((task_i, None, traceback.format_exc()))
+    # flush the results before the process exits
+    result_queue.close()
+    result_queue.join_thread()
+    return
+
+def run_forked_workers(worker_fn, tasks, n_threads=N_THREADS):
+    """Run worker_fn(task) for every task in n_threads forked workers.
+
+    The workers inherit worker_fn (and the arrays that it closes over) from
+    the parent, so only the tasks and results are sent through the queues.
+    Yields (task, result) tuples in the order that the workers finish them. 
+    If a task raises, a RuntimeError with the worker's traceback is raised 
+    (as it is if a worker dies). The workers are killed if the caller raises or stops iterating early.
+    """
+    tasks = list(tasks)
+    if len(tasks) == 0: return
+    n_workers = max(1, min(n_threads, len(tasks)))
+    task_queue = multiprocessing.Queue()
+    result_queue = multiprocessing.Queue()
+    for task_i, task in enumerate(tasks): task_queue.put((task_i, task))
+    for i in xrange(n_workers): task_queue.put(None)
+    pids = [fork_worker(_forked_task_worker, worker_fn, task_queue, result_queue)
+            for i in xrange(n_workers)]
+    finished = False
+    try:
+        for i in xrange(len(tasks)):
+            task_i, result, error = get_worker_result(result_queue, pids)
+            if error is not None:
+                raise RuntimeError("A forked worker failed on task %r:\n%s" % (
+                    tasks[task_i], error))
+            yield tasks[task_i], result
+        finished = True
+    finally:
+        stop_workers(pids, terminate=not finished)
+    return
+
+class NeighborhoodSelector(object):
+    """Meinshausen-Buhlmann neighborhood selection for every gene.
+
+    Each response gene is regressed, with the lasso, on every other gene 
+    that is marginally associated with it (p <= marginal_alpha). alpha is 
+    chosen by two fold cross validation (sample1 vs sample2), and the model
+    is then refit on all of the samples.
+
+    The centered samples x genes design matrices of both folds and of the 
+    full data are built once, and shared by every response. Each response's
+    lasso_path calls run along its own alpha grid (see build_alpha_grid), 
+    warm starting each alpha from the previous alpha's solution.
+    """
+    def __init__(self, sample1, sample2, marginal_alpha=0.50, 
+                 n_alphas=LASSO_N_ALPHAS, eps=LASSO_EPS):
+        self.n_alphas = n_alphas
+        self.eps = eps
+        merged_samples = numpy.hstack((sample1, sample2))
+        # normalize to sum 1
+        self.merged_samples = ((merged_samples.T)/(merged_samples.sum(1))).T
+        self.standardized_samples = standardize_rows(self.merged_samples)
+        self.marginal_alpha = marginal_alpha
+        
+        n_tps = sample1.shape[1]
+        self.folds = [ (numpy.arange(n_tps), numpy.arange(n_tps, 2*n_tps)),
+                       (numpy.arange(n_tps, 2*n_tps), numpy.arange(n_tps)) ]
+        # the train and test matrices are centered with the train means, so
+        # the fitted models have an intercept
+        self.train_X, self.test_X = [], []
+        for train, test in self.folds:
+            means = self.merged_samples[:,train].mean(1)
+            self.train_X.append(self.merged_samples[:,train].T - means)
+            self.test_X.append(self.merged_samples[:,test].T - means)
+        self.X = (self.merged_samples.T - self.merged_samples.mean(1))
+
+    def build_alpha_grid(self, resp_index, pred_indices):
+        """Return resp_index's alpha grid, or None if every coefficient is 
+        zero at any alpha (e.g. the response is constant).
+
+        max_i |x_i^T y|/n (with x_i and y centered) is the smallest alpha 
+        that zeros every coefficient, and the grid runs from the largest 
+        of these over the folds and the full data down to eps times it. A 
+        grid shared by every response would be set by the highest variance
+        genes, and would zero the low variance genes' coefficients along 
+        most of its length.
+        """
+        if len(pred_indices) == 0:
+            return None
+        response = self.merged_samples[resp_index,:]
+        responses = [response[train] for train, test in self.folds] + [response]
+        alpha_max = max(
+            numpy.abs(X[:,pred_indices].T.dot(y - y.mean())).max()/X.shape[0]
+            for X, y in zip(self.train_X + [self.X], responses))
+        if not alpha_max > 0: 
+            return None
+        return numpy.logspace(numpy.log10(alpha_max), 
+                              numpy.log10(alpha_max*self.eps), self.n_alphas)
+
+    def find_predictors(self, resp_index):
+        """Return the indices of the genes marginally associated with 
+        resp_index (always including the most significant one).
+        """
+        corr = self.standardized_samples.dot(
+            self.standardized_samples[resp_index])
+        with numpy.errstate(invalid='ignore'):
+            p_values = corr_to_pvalue(corr, self.merged_samples.shape[1])
+            pred_mask = ~(p_values > self.marginal_alpha)
+        pred_mask[resp_index] = False
+        p_values[resp_index] = numpy.nan
+        if not numpy.isnan(p_values).all():
+            pred_mask[numpy.nanargmin(p_values)] = True
+        return pred_mask.nonzero()[0]
+
+    def fit(self, resp_index):
+        """Return resp_index's alpha and regression coefficients (zero for
+        the gene itself and the filtered genes).
+        """
+        pred_indices = self.find_predictors(resp_index)
+        response = self.merged_samples[resp_index,:]
+        rv = numpy.zeros(self.merged_samples.shape[0], dtype=float)
+        alphas = self.build_alpha_grid(resp_index, pred_indices)
+        if alphas is None:
+            return 0.0, rv
+        
+        # choose alpha by the mean squared error over both folds
+        mse = numpy.zeros(len(alphas))
+        for (train, test), train_X, test_X in zip(
+                self.folds, self.train_X, self.test_X):
+            y_mean = response[train].mean()
+            _, coefs, _ = linear_model.lasso_path(
+                numpy.asfortranarray(train_X[:,pred_indices]), 
+                response[train] - y_mean, alphas=alphas, max_iter=100000)
+            residuals = ( (response[test] - y_mean)[:,None] 
+                          - test_X[:,pred_indices].dot(coefs) )
+            mse += (residuals**2).mean(0)
+        best_i = int(mse.argmin())
+        
+        # refit on every sample, warm starting down the path to the best alpha
+        _, coefs, _ = linear_model.lasso_path(
+            numpy.asfortranarray(self.X[:,pred_indices]), 
+            response - response.mean(), alphas=alphas[:best_i+1], 
+            max_iter=100000)
+        rv[pred_indices] = coefs[:,-1]
+        return alphas[best_i], rv
+
+def _fit_neighborhood_batch(selector, batch):
+    results = []
+    for resp_index in batch:
+        alpha, coefs = selector.fit(resp_index)
+        nonzero = coefs.nonzero()[0]
+        results.append(
+            (resp_index, alpha, nonzero.astype('int32'), coefs[nonzero]))
+    return results
+
+def iter_neighborhood_selections(
+        selector, resp_indices, n_threads=N_THREADS, 
+        batch_size=NEIGHBORHOOD_BATCH_SIZE):
+    """Fit the neighborhood of every gene in resp_indices. 
+
+    The responses are dealt to n_threads forked workers (run_forked_workers)
+    in batches of batch_size. The workers share the selector's design 
+    matrices with the parent, and only send back the nonzero coefficients. 
+
+    Yields (resp_index, alpha, nonzero indices, nonzero coefs) tuples in the
+    order that the workers finish them.
+    """
+    resp_indices = list(resp_indices)
+    batches = [ resp_indices[i:i+batch_size] 
+                for i in xrange(0, len(resp_indices), batch_size) ]
+    for batch, results in run_forked_workers(
+            lambda batch: _fit_neighborhood_batch(selector, batch), 
+            batches, n_threads):
+        for result in results:
+            yield result
+    return
+
+def estimate_covariates(sample1, sample2, resp_index, alpha=0.50):
+    alpha, coefs = NeighborhoodSelector(sample1, sample2, alpha).fit(resp_index)
+    return alpha, coefs.tolist()
+
+def estimate_skeleton_from_samples(sample1, sample2, labels, thresh_ratio=1000,
+                                   n_threads=N_THREADS, ofp=None):
+    """Estimate the skeleton by neighborhood selection.
+
+    If ofp is set, every gene's alpha and nonzero coefficients are written 
+    to it as a line of 'label alpha neighbor:coef ...' as they are fit.
+    """
+    selector = NeighborhoodSelector(sample1, sample2)
     G = nx.DiGraph()
     for i in xrange(sample1.shape[0]):
         G.add_node(i, label=labels[i])
-        alpha, regression_coefs = estimate_covariates(sample1, sample2, i)
-        max_coef = max(numpy.abs(regression_coefs))
-        for j, val in enumerate(regression_coefs):
+    for i, alpha, nonzero, coefs in iter_neighborhood_selections(
+            selector, xrange(sample1.shape[0]), n_threads):
+        if ofp is not None:
+            ofp.write("%s\t%e\t%s\n" % (labels[i], alpha, "\t".join(
+                "%s:%e" % (labels[j], val) 
+                for j, val in zip(nonzero.tolist(), coefs.tolist()))))
+        if len(coefs) == 0: continue
+        max_coef = numpy.abs(coefs).max()
+        for j, val in zip(nonzero.tolist(), coefs.tolist()):
             if abs(val) > 1e-6 and abs(val) >= max_coef/thresh_ratio:
                 G.add_edge(i, j, weight=val)
     
@@ -189,82 +579,514 @@ def estimate_marginal_correlations(merged_samples, resp_index, alpha=ALPHA,
         del sig_samples[-1]
     return sig_samples[:max_num_neighbors]
 
-def estimate_initial_skeleton(normalized_data, labels, alpha):
-    print "Estimating marginal independence relationships"
-    # initialize a graph storing the covariance structure
-    manager = multiprocessing.Manager()
-    edges_and_data = manager.list()
-    curr_node = multiprocessing.Value('i', 0)
+def corr_to_pvalue(corr, n):
+    """Two sided p-values for pearson correlations estimated from n samples.
+
+    This is a vectorized version of the p-value that scipy.stats.pearsonr 
+    computes - t**2 = r**2*df/(1-r**2) which simplifies the incomplete beta 
+    function argument df/(df+t**2) to 1-r**2.
+    """
+    df = n - 2
+    corr = numpy.clip(numpy.abs(corr), 0.0, 1.0)
+    return special.betainc(0.5*df, 0.5, 1.0 - corr**2)
+
+def standardize_rows(data):
+    """Center every row and scale it to unit norm.
+
+    The dot product of two standardized rows is their pearson correlation. 
+    Constant rows become nan, and so do all of their correlations.
+    """
+    centered = data - data.mean(1)[:,None]
+    norms = numpy.sqrt((centered**2).sum(1))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return centered/norms[:,None]
+
+def iter_marginal_correlation_blocks(
+        normalized_data, alpha=ALPHA, rep1=REP1_COLS, rep2=REP2_COLS,
+        block_size=MARGINAL_CORR_BLOCK_SIZE, max_num_neighbors=10000,
+        start=0, stop=None, step=None, n_samples=None):
+    """Find all significant cross replicate correlations, one block at a time.
+
+    This computes the same statistic as estimate_marginal_correlations for 
+    every pair i < j (with i in [start, stop)) - the more significant of 
+    corr(j[rep1], i[rep2]) and corr(j[rep2], i[rep1]) - but with a tile of
+    matrix multiplies instead of a pearsonr call per pair. 
+
+    The blocks start at start, start+step, ... (step defaults to block_size), 
+    so that the O0 workers can interleave the blocks between them. The 
+    p-values are computed for n_samples samples, which defaults to len(rep1) 
+    (see estimate_skeleton_serial for when they differ).
+
+    Yields (src, dst, corr, marginal_p) arrays for each block of rows.
+    """
     n_nodes = normalized_data.shape[0]
-    pids = []
-    for p_index in xrange(N_THREADS):
-        pid = os.fork()
-        if pid == 0:
-            while True:
-                with curr_node.get_lock():
-                    node = curr_node.value
-                    if node >= n_nodes: break
-                    curr_node.value += 1
-                if node%100 == 0: 
-                    print "O0: Finished processing %i/%i nodes" % (
-                        node, n_nodes)
-                marginal_dep = estimate_marginal_correlations(
-                    normalized_data, node, alpha)
-                edges_and_data.append((node, marginal_dep ))
-            os._exit(0)
+    if stop is None: stop = n_nodes
+    if step is None: step = block_size
+    if n_samples is None: n_samples = len(rep1)
+    # standardize the replicate slices once 
+    Z1 = standardize_rows(normalized_data[:,rep1])
+    Z2 = standardize_rows(normalized_data[:,rep2])
+    for i_start in xrange(start, stop, step):
+        i_stop = min(i_start+block_size, stop)
+        block_src, block_dst, block_corr, block_p = [], [], [], []
+        for j_start in xrange(i_start, n_nodes, block_size):
+            j_stop = min(j_start+block_size, n_nodes)
+            # corr(j[rep1], i[rep2]) and corr(j[rep2], i[rep1])
+            corr1 = Z2[i_start:i_stop].dot(Z1[j_start:j_stop].T)
+            corr2 = Z1[i_start:i_stop].dot(Z2[j_start:j_stop].T)
+            # keep the more significant correlation. The pearson p-value is 
+            # monotone in abs(corr), so this matches the p-value comparison
+            # in estimate_marginal_correlations (including for nans)
+            with numpy.errstate(invalid='ignore'):
+                corr = numpy.where(
+                    numpy.abs(corr1) > numpy.abs(corr2), corr1, corr2)
+                p_values = corr_to_pvalue(corr, n_samples)
+                sig = p_values < alpha
+            # only keep the upper triangle 
+            if j_start < i_stop:
+                sig &= ( numpy.arange(j_start, j_stop)[None,:] 
+                         > numpy.arange(i_start, i_stop)[:,None] )
+            rows, cols = sig.nonzero()
+            block_src.append(rows + i_start)
+            block_dst.append(cols + j_start)
+            block_corr.append(corr[rows, cols])
+            block_p.append(p_values[rows, cols])
+        src, dst = numpy.hstack(block_src), numpy.hstack(block_dst)
+        corr, p_values = numpy.hstack(block_corr), numpy.hstack(block_p)
+
+        # keep at most max_num_neighbors per node, preferring the most 
+        # significant correlations
+        if len(src) > 0 and numpy.bincount(src).max() > max_num_neighbors:
+            order = numpy.lexsort((-corr, p_values, src))
+            src, dst = src[order], dst[order]
+            corr, p_values = corr[order], p_values[order]
+            row_starts = numpy.searchsorted(src, src)
+            keep = numpy.arange(len(src)) - row_starts < max_num_neighbors
+            src, dst = src[keep], dst[keep]
+            corr, p_values = corr[keep], p_values[keep]
+
+        record_pc_event('O0_block', n_processed_nodes=i_stop, 
+                        n_nodes=n_nodes, n_edges=len(src))
+        yield src, dst, corr, p_values
+    return
+
+class CompactGraph(object):
+    """A compact graph over the nodes 0..n_nodes-1, used by the PC hot loops.
+
+    Every node has a set of successors and a set of predecessors, stored in
+    lists indexed by the node id. An undirected edge a--b is stored as the 
+    two arcs a->b and b->a, so orienting an edge is removing one of its arcs.
+    Edge attributes are stored by (min(a,b), max(a,b)).
+
+    The skeleton methods (add_edge, remove_edge, edges, neighbors) follow the
+    networkx Graph semantics, and the orientation methods (has_edge, 
+    remove_arc, arcs, successors, predecessors) follow the DiGraph semantics.
+    Use to_networkx/from_networkx to convert at the file output boundary.
+    """
+    def __init__(self, labels):
+        self.labels = list(labels)
+        self.succ = [set() for i in xrange(len(self.labels))]
+        self.pred = [set() for i in xrange(len(self.labels))]
+        self.edge_data = {}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def nodes(self):
+        return range(len(self.labels))
+
+    def add_arc(self, a, b):
+        self.succ[a].add(b)
+        self.pred[b].add(a)
+
+    def remove_arc(self, a, b):
+        self.succ[a].discard(b)
+        self.pred[b].discard(a)
+
+    def add_edge(self, a, b, **attrs):
+        """Add the undirected edge a--b."""
+        self.add_arc(a, b)
+        self.add_arc(b, a)
+        self.edge_data.setdefault((min(a, b), max(a, b)), {}).update(attrs)
+
+    def remove_edge(self, a, b):
+        """Remove a and b's adjacency (both arcs)."""
+        self.remove_arc(a, b)
+        self.remove_arc(b, a)
+        self.edge_data.pop((min(a, b), max(a, b)), None)
+
+    def has_edge(self, a, b):
+        """Return True if there is an arc a->b."""
+        return b in self.succ[a]
+
+    def is_undirected(self, a, b):
+        return b in self.succ[a] and a in self.succ[b]
+
+    def is_adjacent(self, a, b):
+        return b in self.succ[a] or a in self.succ[b]
+
+    def edge_attr(self, a, b, key):
+        return self.edge_data[(min(a, b), max(a, b))][key]
+
+    def successors(self, node):
+        return self.succ[node]
+
+    def predecessors(self, node):
+        return self.pred[node]
+
+    def neighbors(self, node):
+        return self.succ[node] | self.pred[node]
+
+    def undirected_neighbors(self, node):
+        return self.succ[node] & self.pred[node]
+
+    def degree(self, node):
+        return len(self.neighbors(node))
+
+    def edges(self):
+        """Return every adjacency once, as (a, b) with a < b."""
+        return sorted(self.edge_data)
+
+    def number_of_edges(self):
+        return len(self.edge_data)
+
+    def arcs(self):
+        return [(a, b) for a in xrange(len(self.labels)) for b in self.succ[a]]
+
+    def copy(self):
+        G = CompactGraph(self.labels)
+        G.succ = [set(x) for x in self.succ]
+        G.pred = [set(x) for x in self.pred]
+        G.edge_data = dict((k, dict(v)) for k, v in self.edge_data.iteritems())
+        return G
+
+    def is_acyclic(self):
+        """Return True if the arcs form a DAG (undirected edges are cycles).
+        """
+        in_degree = [len(x) for x in self.pred]
+        pending = [node for node, cnt in enumerate(in_degree) if cnt == 0]
+        n_visited = 0
+        while len(pending) > 0:
+            node = pending.pop()
+            n_visited += 1
+            for child in self.succ[node]:
+                in_degree[child] -= 1
+                if in_degree[child] == 0: pending.append(child)
+        return n_visited == len(self.labels)
+
+    @staticmethod
+    def from_edge_arrays(labels, src, dst, **attrs):
+        """Build the skeleton with the undirected edges src[i]--dst[i].
+
+        attrs maps every edge attribute name to an array aligned with src.
+        The adjacency sets are built from the CSR arrays one node at a time, 
+        rather than one add_edge call per edge.
+        """
+        G = CompactGraph(labels)
+        indptr, indices, _ = edge_arrays_to_csr(len(labels), src, dst)
+        for node in xrange(len(labels)):
+            neighbors = indices[indptr[node]:indptr[node+1]].tolist()
+            G.succ[node] = set(neighbors)
+            G.pred[node] = set(neighbors)
+        keys = zip(numpy.minimum(src, dst).tolist(), 
+                   numpy.maximum(src, dst).tolist())
+        names = sorted(attrs)
+        values = ( zip(*[attrs[name].tolist() for name in names]) 
+                   if len(names) > 0 else [()]*len(keys) )
+        G.edge_data = dict(
+            (key, dict(zip(names, x))) for key, x in zip(keys, values))
+        return G
+
+    def to_networkx(self, directed=True):
+        """Convert to a networkx DiGraph (or Graph if directed is False).
+        """
+        G = nx.DiGraph() if directed else nx.Graph()
+        for node, label in enumerate(self.labels):
+            G.add_node(node, label=label)
+        if directed:
+            for a, b in self.arcs():
+                G.add_edge(a, b, **self.edge_data.get((min(a,b), max(a,b)), {}))
         else:
-            pids.append(pid)
-    try:
-        for pid in pids:
-            os.waitpid(pid, 0)
-    except:
-        for pid in pids:
-            os.kill(pid, signal.SIGTERM)
-        raise
-    
-    print "Building O0 graph skeleton from marginal independence data"
-    G = nx.Graph()
-    for i, data in edges_and_data:
-        if not G.has_node(i): G.add_node(i, label=labels[i])
-        for p, corr, j in data:
-            if not G.has_node(j): G.add_node(j, label=labels[j])
-            G.add_edge(i, j, corr=corr, marginal_p=p)
+            for (a, b), data in sorted(self.edge_data.iteritems()):
+                G.add_edge(a, b, **data)
+        return G
+
+    @staticmethod
+    def from_networkx(G):
+        """Convert a networkx graph with nodes 0..n-1 into a CompactGraph.
+        """
+        nodes = sorted(G.nodes())
+        assert nodes == range(len(nodes))
+        rv = CompactGraph([G.node[node].get('label', node) for node in nodes])
+        for a, b, data in G.edges(data=True):
+            if G.is_directed():
+                rv.add_arc(a, b)
+                rv.edge_data.setdefault((min(a, b), max(a, b)), {}).update(data)
+            else:
+                rv.add_edge(a, b, **data)
+        return rv
+
+def edge_arrays_to_csr(n_nodes, src, dst):
+    """Return the symmetric CSR adjacency of the edges src[i]--dst[i].
+
+    Returns (indptr, indices, edge_index), where each node's neighbors are 
+    sorted and edge_index maps every entry of indices to its position in src.
+    """
+    src = numpy.asarray(src, dtype='int64')
+    dst = numpy.asarray(dst, dtype='int64')
+    rows = numpy.concatenate((src, dst))
+    cols = numpy.concatenate((dst, src))
+    order = numpy.lexsort((cols, rows))
+    indptr = numpy.zeros(n_nodes+1, dtype='int64')
+    indptr[1:] = numpy.cumsum(numpy.bincount(rows, minlength=n_nodes))
+    indices = cols[order].astype('int32')
+    edge_index = order % max(1, len(src))
+    return indptr, indices, edge_index
+
+class _CSRNeighborSets(object):
+    """The succ view of a CSRSkeleton - succ[node] is node's neighbor set."""
+    def __init__(self, G):
+        self.G = G
     
-    manager.shutdown()
+    def __getitem__(self, node):
+        return self.G.neighbors(node)
+
+class CSRSkeleton(object):
+    """An undirected PC skeleton stored as symmetric CSR arrays.
+
+    Each node's neighbors are indices[indptr[node]:indptr[node+1]], sorted, 
+    and every edge attribute is a float32 array aligned with indices. A 
+    removed edge is only flagged in the boolean array removed (aligned with
+    indices, in both directions), and neighbor sets are built on demand for
+    the nodes that are tested, so the skeleton never holds a python object
+    per edge. compact drops the removed edges from the arrays, which are 
+    never modified in place (they may be views of shared memory, see 
+    PCWorkerPool).
+
+    This implements the part of the CompactGraph interface that the 
+    skeleton search uses. Use to_compact_graph to orient the skeleton.
+    """
+    def __init__(self, labels, indptr, indices, **attrs):
+        self.labels = list(labels)
+        self.indptr = indptr
+        self.indices = indices
+        self.attrs = attrs
+        self.removed = numpy.zeros(len(indices), dtype=bool)
+        self.n_removed = 0
+
+    @property
+    def succ(self):
+        # built on access, so that the skeleton isn't in a reference cycle
+        # (the PC workers run with the garbage collector disabled)
+        return _CSRNeighborSets(self)
+
+    @staticmethod
+    def from_edge_arrays(labels, src, dst, **attrs):
+        """Build the skeleton with the undirected edges src[i]--dst[i].
+
+        attrs maps every edge attribute name to an array aligned with src.
+        """
+        indptr, indices, edge_index = edge_arrays_to_csr(len(labels), src, dst)
+        return CSRSkeleton(labels, indptr, indices, **dict(
+            (name, numpy.asarray(values, dtype='float32')[edge_index])
+            for name, values in attrs.iteritems()))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def nodes(self):
+        return range(len(self.labels))
+
+    def _find(self, a, b):
+        """Return the position of the edge a--b in indices, or -1."""
+        start, stop = self.indptr[a], self.indptr[a+1]
+        i = start + self.indices[start:stop].searchsorted(b)
+        if i < stop and self.indices[i] == b and not self.removed[i]:
+            return i
+        return -1
+
+    def neighbors(self, node):
+        start, stop = self.indptr[node], self.indptr[node+1]
+        neighbors = self.indices[start:stop]
+        if self.n_removed > 0:
+            neighbors = neighbors[~self.removed[start:stop]]
+        return set(neighbors.tolist())
+
+    def degree(self, node):
+        start, stop = self.indptr[node], self.indptr[node+1]
+        return int(stop - start) - int(self.removed[start:stop].sum())
+
+    def has_edge(self, a, b):
+        return self._find(a, b) >= 0
+
+    def edge_attr(self, a, b, key):
+        i = self._find(a, b)
+        if i < 0: raise KeyError((a, b))
+        return float(self.attrs[key][i])
+
+    def remove_edge(self, a, b):
+        """Remove the edge a--b (if it exists)."""
+        i = self._find(a, b)
+        if i < 0: return
+        self.removed[i] = True
+        self.removed[self._find(b, a)] = True
+        self.n_removed += 1
+
+    def number_of_edges(self):
+        return len(self.indices)//2 - self.n_removed
+
+    def edge_arrays(self):
+        """Return the (src, dst, attrs) arrays of the edges.
+
+        Every edge is stored once, with src < dst, sorted by (src, dst), and 
+        attrs maps every attribute name to an array aligned with src.
+        """
+        n_nodes = len(self.labels)
+        rows = numpy.repeat(
+            numpy.arange(n_nodes, dtype='int64'), numpy.diff(self.indptr))
+        keep = (self.indices > rows) & ~self.removed
+        return ( rows[keep].astype('int32'), self.indices[keep], 
+                 dict((name, values[keep]) 
+                      for name, values in self.attrs.iteritems()) )
+
+    def edges(self):
+        """Return every edge once, as (a, b) with a < b."""
+        src, dst, _ = self.edge_arrays()
+        return zip(src.tolist(), dst.tolist())
+
+    def compact(self):
+        """Rebuild the arrays without the removed edges."""
+        if self.n_removed == 0: return
+        src, dst, attrs = self.edge_arrays()
+        indptr, indices, edge_index = edge_arrays_to_csr(
+            len(self.labels), src, dst)
+        self.indptr, self.indices = indptr, indices
+        self.attrs = dict((name, values[edge_index]) 
+                          for name, values in attrs.iteritems())
+        self.removed = numpy.zeros(len(indices), dtype=bool)
+        self.n_removed = 0
+
+    def copy(self):
+        # the arrays (other than removed) are never modified in place, so 
+        # they can be shared
+        G = CSRSkeleton(self.labels, self.indptr, self.indices, **self.attrs)
+        G.removed = self.removed.copy()
+        G.n_removed = self.n_removed
+        return G
+
+    def to_compact_graph(self):
+        """Return the skeleton as a CompactGraph (e.g. to orient it)."""
+        src, dst, attrs = self.edge_arrays()
+        return CompactGraph.from_edge_arrays(self.labels, src, dst, **attrs)
+
+def _write_marginal_correlation_edges(
+        ofname, normalized_data, alpha, rep1, rep2, block_size, start, step, 
+        n_samples):
+    """Stream the O0 edges of the row blocks start, start+step, ... to ofname.
+    """
+    with open(ofname, "wb") as ofp:
+        for src, dst, corr, p_values in iter_marginal_correlation_blocks(
+                normalized_data, alpha, rep1, rep2, block_size=block_size, 
+                start=start, step=step, n_samples=n_samples):
+            records = numpy.empty(len(src), dtype=O0_EDGE_DTYPE)
+            records['src'] = src
+            records['dst'] = dst
+            records['corr'] = corr
+            records['marginal_p'] = p_values
+            records.tofile(ofp)
+    return
+
+def find_marginal_correlation_edges(
+        normalized_data, alpha, rep1=REP1_COLS, rep2=REP2_COLS, 
+        n_threads=N_THREADS, n_samples=None):
+    """Find the O0 edges with n_threads forked workers.
+
+    The row blocks are dealt round robin to the workers (the blocks shrink 
+    along the upper triangle), and every worker streams its edges as 
+    O0_EDGE_DTYPE records to its own file (see run_forked_workers), so no 
+    edges are sent through a queue. The files are then read into one 
+    preallocated array. With a single worker, the blocks are processed in 
+    this process. See iter_marginal_correlation_blocks for n_samples.
+
+    Returns the (src, dst, corr, marginal_p) arrays (int32 and float32).
+    """
+    block_size = MARGINAL_CORR_BLOCK_SIZE
+    n_blocks = (normalized_data.shape[0] + block_size - 1)//block_size
+    n_workers = max(1, min(n_threads, n_blocks))
+    if n_workers == 1:
+        blocks = list(iter_marginal_correlation_blocks(
+            normalized_data, alpha, rep1, rep2, block_size=block_size, 
+            n_samples=n_samples))
+        edges = numpy.empty(sum(len(x[0]) for x in blocks), dtype=O0_EDGE_DTYPE)
+        for i, name in enumerate(edges.dtype.names):
+            edges[name] = numpy.concatenate(
+                [x[i] for x in blocks] + [numpy.zeros(0)])
+        return edges['src'], edges['dst'], edges['corr'], edges['marginal_p']
+    tmp_dir = tempfile.mkdtemp(prefix="pc_O0_")
+    try:
+        fnames = [os.path.join(tmp_dir, "edges.%i.bin" % i) 
+                  for i in xrange(n_workers)]
+        for i, _ in run_forked_workers(
+                lambda i: _write_marginal_correlation_edges(
+                    fnames[i], normalized_data, alpha, rep1, rep2, 
+                    block_size, start=i*block_size, step=n_workers*block_size,
+                    n_samples=n_samples),
+                range(n_workers), n_workers):
+            pass
+
+        n_edges = sum(os.path.getsize(fname)//O0_EDGE_DTYPE.itemsize
+                      for fname in fnames)
+        edges = numpy.empty(n_edges, dtype=O0_EDGE_DTYPE)
+        n_read = 0
+        for fname in fnames:
+            worker_edges = numpy.fromfile(fname, dtype=O0_EDGE_DTYPE)
+            edges[n_read:n_read+len(worker_edges)] = worker_edges
+            n_read += len(worker_edges)
+            del worker_edges
+            os.remove(fname)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return edges['src'], edges['dst'], edges['corr'], edges['marginal_p']
+
+def estimate_initial_skeleton(normalized_data, labels, alpha, 
+                              rep1=REP1_COLS, rep2=REP2_COLS,
+                              n_threads=N_THREADS, n_samples=None):
+    record_pc_event('O0_start', n_nodes=len(labels))
+    start_time = time.time()
+    src, dst, corr, p_values = find_marginal_correlation_edges(
+        normalized_data, alpha, rep1, rep2, n_threads, n_samples)
+    G = CSRSkeleton.from_edge_arrays(
+        labels, src, dst, corr=corr, marginal_p=p_values)
+    record_pc_event('O0', n_nodes=len(labels), n_edges=G.number_of_edges(),
+                    elapsed=time.time()-start_time)
     return G
 
 
 def find_unoriented_edges(G):
     unoriented_edges = set()
-    for start, stop in G.edges():
-        if start > stop: continue
-        if G.has_edge(stop, start):
-            unoriented_edges.add((start, stop))
+    for start in G.nodes():
+        for stop in G.succ[start]:
+            if start > stop: continue
+            if start in G.succ[stop]:
+                unoriented_edges.add((start, stop))
     return sorted(unoriented_edges)
 
 def iter_unoriented_v_structures(G):
-    for node, node_data in G.nodes(data=True):
-        neighbors = [neighbor for neighbor in nx.all_neighbors(G, node)
-                     if G.has_edge(neighbor, node) and G.has_edge(node, neighbor)]
-        for n1 in neighbors:
-            for n2 in neighbors:
-                if n1 >= n2: 
-                    continue
-                if G.has_edge(n1, n2) or G.has_edge(n2, n1): 
+    for node in G.nodes():
+        neighbors = sorted(G.succ[node] & G.pred[node])
+        for i, n1 in enumerate(neighbors):
+            for n2 in neighbors[i+1:]:
+                if n2 in G.succ[n1] or n1 in G.succ[n2]: 
                     continue
                 yield n1, node, n2
     return
 
 def iter_colliders(G):
-    for node, node_data in G.nodes(data=True):
-        predecessors = [predecessor for predecessor in G.predecessors(node)
-                        if not G.has_edge(node, predecessor) 
-                        and G.has_edge(predecessor, node)]
-        for n1 in predecessors:
-            assert G.has_edge(n1, node)
-            assert not G.has_edge(node, n1)
-            for n2 in predecessors:
-                if n1 >= n2: continue
+    for node in G.nodes():
+        predecessors = sorted(predecessor for predecessor in G.pred[node]
+                              if predecessor not in G.succ[node])
+        for i, n1 in enumerate(predecessors):
+            for n2 in predecessors[i+1:]:
                 yield n1, node, n2
     return
 
@@ -272,39 +1094,119 @@ def orient_single_v_structure(G, data):
     for a, c, b in iter_unoriented_v_structures(G):
         if not are_cond_indep(a, b, c, data):
             # remove the edges point from c to a and b
-            try: G.remove_edge(c, a)
-            except: pass
-            try: G.remove_edge(c, b)
-            except: pass
+            G.remove_arc(c, a)
+            G.remove_arc(c, b)
             
             if VERBOSE:
                 print "Orienting %s->%s<-%s" % (
-                    G.node[a]['label'], G.node[c]['label'], G.node[b]['label'])
+                    G.labels[a], G.labels[c], G.labels[b])
             return True
     
     return False
 
+def build_separating_set_index(ci_sets):
+    """Index the separating sets by (min(a,b), max(a,b)).
+
+    The CI sets are keyed by the order that the edge was tested in, so this
+    makes the lookup independent of the order of a and b.
+    """
+    index = {}
+    for (a, b), ci_set in ci_sets.iteritems():
+        index[(min(a, b), max(a, b))] = frozenset(ci_set)
+    return index
+
+def undirected_adjacency_matrix(G, undirected_only=True):
+    """Return G's adjacency matrix as a boolean scipy.sparse CSR matrix.
+
+    If undirected_only is set, only edges with both arcs are included, 
+    otherwise every adjacency is.
+    """
+    rows, cols = [], []
+    for a, b in G.arcs():
+        if undirected_only and a not in G.succ[b]: continue
+        rows.append(a)
+        cols.append(b)
+        if not undirected_only:
+            rows.append(b)
+            cols.append(a)
+    A = scipy.sparse.csr_matrix(
+        (numpy.ones(len(rows), dtype=bool), (rows, cols)), 
+        shape=(len(G), len(G)), dtype=bool)
+    A.sort_indices()
+    return A
+
+def find_unshielded_triples(G):
+    """Find every triple a--c--b where a < b are not adjacent.
+
+    For each middle node c, the candidate endpoint pairs are the upper 
+    triangle of c's (sorted) undirected neighbor array, and the pairs that
+    are adjacent in the adjacency matrix are dropped.
+
+    Returns an (n_triples, 3) array of (a, c, b) rows, sorted.
+    """
+    A = undirected_adjacency_matrix(G)
+    adjacent = undirected_adjacency_matrix(G, undirected_only=False)
+    triples = []
+    for c in xrange(len(G)):
+        neighbors = A.indices[A.indptr[c]:A.indptr[c+1]]
+        if len(neighbors) < 2: continue
+        i, j = numpy.triu_indices(len(neighbors), k=1)
+        a_arr, b_arr = neighbors[i], neighbors[j]
+        unshielded = ~numpy.asarray(adjacent[a_arr, b_arr]).ravel()
+        n_triples = unshielded.sum()
+        if n_triples == 0: continue
+        triples.append(numpy.column_stack((
+            a_arr[unshielded], numpy.repeat(c, n_triples), b_arr[unshielded])))
+    if len(triples) == 0:
+        return numpy.zeros((0, 3), dtype=int)
+    triples = numpy.vstack(triples)
+    return triples[numpy.lexsort((triples[:,1], triples[:,2], triples[:,0]))]
+
 def orient_v_structures(G, ci_sets):
-    for a, c, b in iter_unoriented_v_structures(G):
+    """Orient every unshielded triple a--c--b into a v-structure a->c<-b 
+       unless c is in a and b's separating set.
+
+    All triples are found in the graph before any edges are oriented. If two
+    v-structures disagree on an edge's orientation, the edge is left 
+    undirected (rather than losing both arcs) and is returned in the list of
+    conflicting edges. Records a 'v_structures' event with the number of 
+    triples, oriented arcs and conflicting edges.
+    """
+    start_time = time.time()
+    sepsets = build_separating_set_index(ci_sets)
+    # the arcs that need to be removed, to orient the v-structures
+    arcs_to_remove = set()
+    triples = find_unshielded_triples(G)
+    for a, c, b in triples.tolist():
         # the a and b are marginally independent or they
         # are independent conditionally on c orient the edges
-        if (a,b) not in ci_sets or c not in ci_sets[(a,b)]:
-            # remove the edges point from c to a and b
-            try: G.remove_edge(c, a)
-            except: pass
-            try: G.remove_edge(c, b)
-            except: pass
-    return
+        sepset = sepsets.get((a, b))
+        if sepset is None or c not in sepset:
+            arcs_to_remove.add((c, a))
+            arcs_to_remove.add((c, b))
+    
+    conflicts = sorted(set((min(a, b), max(a, b)) 
+                           for a, b in arcs_to_remove 
+                           if (b, a) in arcs_to_remove))
+    n_oriented = 0
+    for a, b in arcs_to_remove:
+        if (b, a) in arcs_to_remove: continue
+        G.remove_arc(a, b)
+        n_oriented += 1
+    record_pc_event('v_structures', n_triples=len(triples), 
+                    n_oriented_arcs=n_oriented, n_conflicts=len(conflicts),
+                    elapsed=time.time()-start_time)
+    return conflicts
 
 def apply_rule_1(b, c, G):
     """Check is there is a directed edge a->b such that a and c are not adjacent
     """
-    for a in G.predecessors(b):
+    for a in G.pred[b]:
         # skip bi-directed edges
-        if G.has_edge(b, a): 
+        if a in G.succ[b]: 
             continue
         # skip adjacent edges
-        if G.has_edge(a, c) or G.has_edge(c, a):
+        if c in G.succ[a] or a in G.succ[c]:
             continue
         return True
     return False
@@ -312,13 +1214,13 @@ def apply_rule_1(b, c, G):
 def apply_rule_2(a, b, G):
     """Check is there is a directed edge a->b such that a and b are not adjacent
     """
-    for c in G.successors(a):
+    for c in G.succ[a]:
         # skip bi-directed edges
-        if G.has_edge(c, a): 
+        if a in G.succ[c]: 
             continue
         # if there also exists a directed edge from c,b 
         # then rule 2 applies
-        if G.has_edge(c, b) and not G.has_edge(b, c):
+        if b in G.succ[c] and c not in G.succ[b]:
             return True
     return False
 
@@ -326,18 +1228,18 @@ def apply_rule_3(a, b, G):
     """Check is there are two chains a--c->b and a--d->b such that 
        c and d are not adjacent.
     """
-    intermediate_nodes = set()
+    intermediate_nodes = []
     # find all such chains
-    for c in G.successors(a):
+    for c in G.succ[a]:
         # skip bi-directed edges
-        if G.has_edge(c, a) and G.has_edge(c, b) and not G.has_edge(b, c): 
-            intermediate_nodes.add(c)
+        c_succ = G.succ[c]
+        if a in c_succ and b in c_succ and c not in G.succ[b]: 
+            intermediate_nodes.append(c)
 
     # try to find a pair of non adjacent nodes
-    for c in intermediate_nodes:
-        for d in intermediate_nodes:
-            if c == d: continue
-            if not G.has_edge(c, d) and not G.has_edge(d, c):
+    for i, c in enumerate(intermediate_nodes):
+        for d in intermediate_nodes[i+1:]:
+            if d not in G.succ[c] and c not in G.succ[d]:
                 return True
     return False
 
@@ -345,17 +1247,17 @@ def apply_rule_4(a, b, G):
     """Check is there is a chain a--c->d->b where c and b are non adjacent.
     """
     # find all such chains
-    for c in G.successors(a):
+    for c in G.succ[a]:
         # skip non bi-directed edges
-        if not G.has_edge(c, a):
+        if a not in G.succ[c]:
             continue
         # skip c that are adjacent to b
-        if G.has_edge(c, b) or G.has_edge(b, c):
+        if b in G.succ[c] or c in G.succ[b]:
             continue
-        for d in G.successors(c):
+        for d in G.succ[c]:
             # skip bi directed edges
-            if G.has_edge(d, c): continue
-            if G.has_edge(d, b) and not G.has_edge(b, d):
+            if c in G.succ[d]: continue
+            if b in G.succ[d] and d not in G.succ[b]:
                 return True
     return False
 
@@ -364,58 +1266,221 @@ def apply_IC_rules(G):
     for a, b in unoriented_edges:
         if apply_rule_1(a, b, G):
             if DEBUG_VERBOSE: print "Applying Rule 1:", a, b
-            G.remove_edge(b ,a)
+            G.remove_arc(b ,a)
             return True
         elif apply_rule_2(a, b, G):
             if DEBUG_VERBOSE: print "Applying Rule 2:", a, b
-            G.remove_edge(b ,a)
+            G.remove_arc(b ,a)
             return True
         elif apply_rule_3(a, b, G):
             if DEBUG_VERBOSE: print "Applying Rule 3:", a, b
-            G.remove_edge(b ,a)
+            G.remove_arc(b ,a)
             return True
         elif apply_rule_4(a, b, G):
             if DEBUG_VERBOSE: print "Applying Rule 4:", a, b
-            G.remove_edge(b ,a)
+            G.remove_arc(b ,a)
             return True
     return False
 
+IC_RULES = (apply_rule_1, apply_rule_2, apply_rule_3, apply_rule_4)
+
+def iter_affected_edges(G, a, b):
+    """Iterate the undirected edges whose rules can change after orienting a->b.
+
+    The new arc can only complete a rule premise for an edge incident to a or
+    b, or (rule 4, a'--a->b->b') for an edge incident to an undirected 
+    neighbor of a.
+    """
+    for node in [a, b] + list(G.undirected_neighbors(a)):
+        for neighbor in G.undirected_neighbors(node):
+            yield min(node, neighbor), max(node, neighbor)
+    return
+
+def propagate_orientations(G, edges=None):
+    """Apply the IC rules to G until no more edges can be oriented.
+
+    This is a worklist version of 'while apply_IC_rules(G): pass'. The 
+    worklist starts with edges (default all of the unoriented edges) and, 
+    after an edge is oriented, only the edges whose rule premises could have
+    changed (iter_affected_edges) are re-examined. Both orientations of 
+    every edge are tested.
 
-def break_cycles(G):
+    Returns the number of edges that were oriented.
+    """
+    if edges is None: edges = find_unoriented_edges(G)
+    pending = deque()
+    queued = set()
+    for a, b in edges:
+        edge = (min(a, b), max(a, b))
+        if edge in queued: continue
+        queued.add(edge)
+        pending.append(edge)
+
+    n_oriented = 0
+    while len(pending) > 0:
+        edge = pending.popleft()
+        queued.remove(edge)
+        a, b = edge
+        if not G.is_undirected(a, b): continue
+        for start, stop in ((a, b), (b, a)):
+            for rule_i, rule in enumerate(IC_RULES):
+                if rule(start, stop, G): break
+            else: 
+                continue
+            if DEBUG_VERBOSE: 
+                print "Applying Rule %i:" % (rule_i+1), start, stop
+            G.remove_arc(stop, start)
+            n_oriented += 1
+            for affected_edge in iter_affected_edges(G, start, stop):
+                if affected_edge in queued: continue
+                queued.add(affected_edge)
+                pending.append(affected_edge)
+            break
+    
+    return n_oriented
+
+
+def maximum_weight_spanning_forest(G):
+    """Return a copy of G with only its maximum abs(weight) spanning forest.
+
+    Kruskal's algorithm - the edges are visited in order of decreasing 
+    abs(weight), and an edge is kept if it joins two different trees of the 
+    union-find forest.
+    """
+    nodes = G.nodes()
+    node_index = dict((node, i) for i, node in enumerate(nodes))
+    edges = G.edges()
+    weights = numpy.array(
+        [abs(G[a][b]['weight']) for a, b in edges], dtype=float)
+    
+    parents = range(len(nodes))
+    def find_root(i):
+        while parents[i] != i:
+            # path halving
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+    
+    edges_to_remove = []
+    for edge_i in numpy.argsort(-weights, kind='mergesort').tolist():
+        a, b = edges[edge_i]
+        a_root = find_root(node_index[a])
+        b_root = find_root(node_index[b])
+        if a_root == b_root:
+            edges_to_remove.append((a, b))
+        else:
+            parents[a_root] = b_root
+    
     G = G.copy()
-    cycles = nx.cycle_basis(G)
-    while len(cycles) > 0:
-        # break cycles
-        edge_cnts = defaultdict(int)
-        edge_weights = {}
-        for cycle in nx.cycle_basis(G):
-            for a,b in zip(cycle[:-1], cycle[1:]) + [(cycle[-1],cycle[0]),]:
-                a, b = min(a,b), max(a,b)
-                edge_cnts[(a,b)] += 1
-                edge_weights[(a,b)] = G[a][b]['weight']
-        edge = sorted(
-            edge_cnts, key=lambda x: (-edge_cnts[x], abs(edge_weights[x])))[0]
-        #print edge, edge_cnts[edge], abs(edge_weights[edge])
-        #print "Removing edge:", edge
+    G.remove_edges_from(edges_to_remove)
+    return G
+
+def break_cycles_by_shared_cycles(G):
+    """Remove the edge in the most cycles until G is acyclic.
+
+    This is the original break_cycles heuristic - the edge with the highest
+    cycle basis count (ties broken by the smallest abs(weight)) is removed 
+    first. Every cycle lies within a single biconnected component, so the 
+    cycle bases are stored per biconnected component and, after removing an
+    edge, only the component that contained it is recomputed. The edge 
+    counts are kept in a heap with lazy deletion.
+    """
+    G = G.copy()
+    def norm_edge(a, b): return (min(a, b), max(a, b))
+    
+    edge_cnts = defaultdict(int)
+    # map edges to the id of their biconnected component
+    edge_components = {}
+    # removed components are set to None, so the ids stay unique
+    components = []
+    heap = []
+    def add_components(edges):
+        subgraph = nx.Graph(list(edges))
+        for component in nx.biconnected_component_edges(subgraph):
+            component = [norm_edge(a, b) for a, b in component]
+            # a single edge is a bridge, so it can't be in a cycle
+            if len(component) < 3: continue
+            component_id = len(components)
+            components.append(component)
+            for cycle in nx.cycle_basis(nx.Graph(component)):
+                for a, b in zip(cycle, cycle[1:] + cycle[:1]):
+                    edge_cnts[norm_edge(a, b)] += 1
+            for edge in component:
+                edge_components[edge] = component_id
+                heapq.heappush(heap, (
+                    -edge_cnts[edge], abs(G[edge[0]][edge[1]]['weight']), edge))
+        return
+    
+    add_components(G.edges())
+    while len(heap) > 0:
+        neg_cnt, weight, edge = heapq.heappop(heap)
+        # skip stale entries
+        if edge not in edge_components or edge_cnts[edge] != -neg_cnt:
+            continue
         G.remove_edge(*edge)
-        cycles = nx.cycle_basis(G)
+        # remove the edge's component counts, and recompute them for the 
+        # component's remaining edges
+        component = components[edge_components[edge]]
+        components[edge_components[edge]] = None
+        for other_edge in component:
+            del edge_components[other_edge]
+            del edge_cnts[other_edge]
+        add_components(x for x in component if x != edge)
     return G
 
-def test_for_CI(G, n1, n2, normalized_data, order, alpha):
+def break_cycles(G, method='spanning_forest'):
+    """Remove edges from the weighted graph G until it is acyclic.
+
+    method is 'spanning_forest', which keeps the maximum abs(weight) 
+    spanning forest, or 'shared_cycles' which removes the edges that are 
+    in the most cycles first (see break_cycles_by_shared_cycles).
+    """
+    if method == 'spanning_forest':
+        return maximum_weight_spanning_forest(G)
+    elif method == 'shared_cycles':
+        return break_cycles_by_shared_cycles(G)
+    else:
+        raise ValueError("Unrecognized cycle breaking method '%s'" % method)
+
+def find_common_neighbors(G, n1, n2, order_subsets):
+    """Return a list of n1 and n2's common neighbors.
+
+    If order_subsets is set, the neighbors are sorted by the weaker of their 
+    marginal associations with n1 and n2 (strongest first), so that 
+    combinations() yields the sets most likely to separate n1 and n2 first.
+    """
+    # the skeleton is undirected, so the successors are the neighbors
+    common_neighbors = (G.succ[n1] & G.succ[n2]) - set((n1, n2))
+    if not order_subsets:
+        return list(common_neighbors)
+    return sorted(common_neighbors, key=lambda x: (
+        max(G.edge_attr(n1, x, 'marginal_p'), G.edge_attr(n2, x, 'marginal_p')),
+        x))
+
+def regression_residuals(normalized_data, node, covariates):
+    """Return the residuals of node regressed on covariates (and an intercept).
+    """
+    N = normalized_data.shape[1]
+    predictors = numpy.hstack(
+        (numpy.ones((N,1), dtype=float), 
+         normalized_data[numpy.array(covariates, dtype=int),:].T))
+    resp = normalized_data[node,:]
+    rv, _, _, _ = lstsq(predictors, resp)
+    return resp - rv.dot(predictors.T)
+
+def test_for_CI_lstsq(G, n1, n2, normalized_data, order, alpha, 
+                      order_subsets=False, n_samples=None):
     """Test if n1 and n2 are conditionally independent. 
 
+    If order_subsets is set, the conditioning sets are tested in the order 
+    given by find_common_neighbors, and the first set that makes n1 and n2 
+    independent at level alpha is returned. If n_samples is set, the 
+    p-values are computed for n_samples samples rather than the number of 
+    columns of normalized_data.
+
     If they are not return None, else return the conditional independence set.
     """
-    N = normalized_data.shape[1]
-    ones = numpy.ones((N,1), dtype=float)
-    
-    n1_resp = normalized_data[n1,:]    
-    n1_neighbors = set(G.neighbors(n1))    
-    
-    n2_resp = normalized_data[n2,:]
-    n2_neighbors = set(G.neighbors(n2))
-    
-    common_neighbors = n1_neighbors.intersection(n2_neighbors) - set((n1, n2))
+    common_neighbors = find_common_neighbors(G, n1, n2, order_subsets)
     # if there aren't enough neighbors common to n1 and n2, return none
     if len(common_neighbors) < order: 
         return None
@@ -426,13 +1491,12 @@ def test_for_CI(G, n1, n2, normalized_data, order, alpha):
     n_common_neighbors = 0
     for covariates in combinations(common_neighbors, order):
         n_common_neighbors += 1
-        predictors = numpy.hstack(
-            (ones, normalized_data[numpy.array(covariates),:].T))
+        CI_TEST_COUNTERS['conditioning_sets'] += 1
         # test if node is independent of neighbors given for some subset
-        rv1, _, _, _ = lstsq(predictors, n1_resp)
-        rv2, _, _, _ = lstsq(predictors, n2_resp)
-        cor, pval =  pearsonr(n1_resp - rv1.dot(predictors.T), 
-                              n2_resp - rv2.dot(predictors.T))
+        cor, pval =  pearsonr(
+            regression_residuals(normalized_data, n1, covariates),
+            regression_residuals(normalized_data, n2, covariates))
+        if n_samples is not None: pval = corr_to_pvalue(cor, n_samples)
         if abs(cor) < min_score:
             min_score = abs(cor)
             best_neighbors = covariates
@@ -440,6 +1504,10 @@ def test_for_CI(G, n1, n2, normalized_data, order, alpha):
         # make the multiple testing correction /n_common_neighbors
         if best_p_val < alpha/n_common_neighbors:
             return None
+        # this set makes n1 and n2 independent, and the best p-value can only
+        # increase, so the edge will be removed
+        if order_subsets and pval >= alpha:
+            return covariates
         #score = math.sqrt(N-order-3)*0.5*math.log((1+cor)/(1-cor))
         #print abs(score),  norm.isf(alpha/(len(neighbors)*2)), cor, pval
         #if abs(score) < norm.isf(alpha/(len(neighbors)*2)): 
@@ -450,6 +1518,233 @@ def test_for_CI(G, n1, n2, normalized_data, order, alpha):
     else:
         return best_neighbors
 
+def iter_partial_correlation_batches(normalized_data, nodes, order):
+    """Yield the absolute partial correlations of nodes[0] and nodes[1] given
+    every order sized subset of nodes[2:], in batches.
+
+    The partial correlation given S is -P[0,1]/sqrt(P[0,0]*P[1,1]) where P
+    is the inverse of the correlation sub-matrix of (n1, n2, S), and the
+    sub-matrices are inverted in batches of CI_TEST_BATCH_SIZE. The subsets
+    are iterated in the same order as test_for_CI_lstsq, so that the
+    multiple testing correction is applied identically.
+
+    Yields (batch, scores), where every row of batch is a subset given as
+    indices into nodes. numpy.linalg.LinAlgError is raised if a sub-matrix
+    is singular.
+    """
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        corr_mat = numpy.corrcoef(normalized_data[numpy.array(nodes),:])
+    subsets = combinations(xrange(2, len(nodes)), order)
+    while True:
+        batch = numpy.array(
+            list(islice(subsets, CI_TEST_BATCH_SIZE)), dtype=int)
+        if len(batch) == 0: break
+        batch = batch.reshape((len(batch), order))
+        CI_TEST_COUNTERS['conditioning_sets'] += len(batch)
+        indices = numpy.hstack((
+            numpy.zeros((len(batch), 1), dtype=int),
+            numpy.ones((len(batch), 1), dtype=int),
+            batch))
+        sub_mats = corr_mat[indices[:,:,None], indices[:,None,:]]
+        prec = numpy.linalg.inv(sub_mats)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            scores = numpy.abs(
+                prec[:,0,1]/numpy.sqrt(prec[:,0,0]*prec[:,1,1]))
+        yield batch, scores
+    return
+
+def lstsq_fallback(ci_test):
+    """Make the correlation matrix CI test ci_test fall back to 
+    test_for_CI_lstsq when its correlation sub-matrices are singular.
+
+    The correlation matrix of N samples has rank at most N-1, so the 
+    sub-matrix of n1, n2 and order neighbors is always singular when 
+    order+2 > N-1 (the PC orders reach N-2), and it can also be singular 
+    for collinear genes (numpy.linalg.LinAlgError). The partial correlations
+    of a singular matrix are meaningless, while the regression residuals of
+    test_for_CI_lstsq are collinear, so n1 and n2 are dependent.
+    """
+    @functools.wraps(ci_test)
+    def wrapped_ci_test(G, n1, n2, normalized_data, order, alpha, 
+                        order_subsets=False, n_samples=None):
+        if order + 3 <= normalized_data.shape[1]:
+            try:
+                return ci_test(G, n1, n2, normalized_data, order, alpha, 
+                               order_subsets, n_samples)
+            except numpy.linalg.LinAlgError:
+                pass
+        CI_TEST_COUNTERS['lstsq_fallbacks'] += 1
+        return test_for_CI_lstsq(G, n1, n2, normalized_data, order, alpha, 
+                                 order_subsets, n_samples)
+    return wrapped_ci_test
+
+@lstsq_fallback
+def test_for_CI_partial_corr(G, n1, n2, normalized_data, order, alpha, 
+                             order_subsets=False, n_samples=None):
+    """Test if n1 and n2 are conditionally independent. 
+
+    This makes the same decision as test_for_CI_lstsq, but computes the
+    partial correlations directly from the correlation matrix of n1, n2 and
+    their common neighbors (see iter_partial_correlation_batches, and 
+    lstsq_fallback for singular correlation matrices). See 
+    test_for_CI_lstsq for order_subsets and n_samples.
+
+    If they are not return None, else return the conditional independence set.
+    """
+    N = normalized_data.shape[1] if n_samples is None else n_samples
+    
+    common_neighbors = find_common_neighbors(G, n1, n2, order_subsets)
+    # if there aren't enough neighbors common to n1 and n2, return none
+    if len(common_neighbors) < order: 
+        return None
+    
+    # n1 and n2 are rows 0 and 1 of the correlation matrix
+    nodes = [n1, n2] + common_neighbors
+
+    min_score = 1e100
+    best_neighbors = None
+    n_common_neighbors = 0
+    for batch, scores in iter_partial_correlation_batches(
+            normalized_data, nodes, order):
+        # the smallest score seen after each test (fmin skips nans, just like 
+        # the 'abs(cor) < min_score' comparison does)
+        running_min = numpy.fmin.accumulate(
+            numpy.hstack(((min_score,), scores)))[1:]
+        n_tests = numpy.arange(
+            n_common_neighbors+1, n_common_neighbors+len(batch)+1)
+        # make the multiple testing correction /n_common_neighbors
+        is_dependent = corr_to_pvalue(running_min, N) < alpha/n_tests
+        if order_subsets:
+            # return the first independent set, unless the test would have 
+            # declared n1 and n2 dependent before reaching it
+            with numpy.errstate(invalid='ignore'):
+                is_independent = corr_to_pvalue(scores, N) >= alpha
+            if is_independent.any():
+                first_i = is_independent.argmax()
+                if is_dependent[:first_i].any(): 
+                    return None
+                return tuple(nodes[i] for i in batch[first_i])
+        if is_dependent.any():
+            return None
+        
+        n_common_neighbors += len(batch)
+        if running_min[-1] < min_score:
+            min_score = running_min[-1]
+            best_i = numpy.nanargmin(scores)
+            best_neighbors = tuple(nodes[i] for i in batch[best_i])
+    
+    # if no score was ever set then the best p-value is None, which (like 
+    # test_for_CI_lstsq) we treat as dependent
+    if best_neighbors is None:
+        return None
+    else:
+        return best_neighbors
+
+# the critical absolute correlations by (N, order, alpha) - see
+# find_critical_correlations
+_CRITICAL_CORRELATIONS = {}
+
+def find_critical_correlations(N, order, alpha, n_tests):
+    """Return the critical |r| of (at least) the first n_tests CI tests.
+
+    Entry k-1 is the |r| above which the running minimum makes n1 and n2
+    dependent after k tests - the Fisher z critical value for alpha/k,
+    tanh(norm.isf(alpha/(2k))/sqrt(N-order-3)). When N-order-3 <= 0 the
+    Fisher z statistic is undefined, and the threshold falls back to the
+    exact one used by the other backends (corr_to_pvalue(r, N) = alpha/k).
+    The table is computed once per (N, order, alpha), and grown by doubling.
+    """
+    key = (N, order, alpha)
+    table = _CRITICAL_CORRELATIONS.get(key)
+    if table is None or len(table) < n_tests:
+        size = max(n_tests, 2*len(table) if table is not None else 64)
+        thresholds = alpha/numpy.arange(1, size+1, dtype=float)
+        if N - order - 3 > 0:
+            table = numpy.tanh(norm.isf(thresholds/2)/math.sqrt(N-order-3))
+        else:
+            df = N - 2
+            table = numpy.sqrt(
+                1.0 - special.betaincinv(0.5*df, 0.5, thresholds))
+        _CRITICAL_CORRELATIONS[key] = table
+    return table
+
+@lstsq_fallback
+def test_for_CI_fisher_z(G, n1, n2, normalized_data, order, alpha, 
+                         order_subsets=False, n_samples=None):
+    """Test if n1 and n2 are conditionally independent with Fisher's z test.
+
+    The partial correlations are computed as in test_for_CI_partial_corr,
+    but the running minimum is compared to the critical correlations from
+    find_critical_correlations, so no p-values are computed. See
+    test_for_CI_lstsq for order_subsets and n_samples.
+
+    If they are not return None, else return the conditional independence set.
+    """
+    N = normalized_data.shape[1] if n_samples is None else n_samples
+
+    common_neighbors = find_common_neighbors(G, n1, n2, order_subsets)
+    # if there aren't enough neighbors common to n1 and n2, return none
+    if len(common_neighbors) < order:
+        return None
+
+    # n1 and n2 are rows 0 and 1 of the correlation matrix
+    nodes = [n1, n2] + common_neighbors
+
+    min_score = 1e100
+    best_neighbors = None
+    n_common_neighbors = 0
+    for batch, scores in iter_partial_correlation_batches(
+            normalized_data, nodes, order):
+        running_min = numpy.fmin.accumulate(
+            numpy.hstack(((min_score,), scores)))[1:]
+        critical_corrs = find_critical_correlations(
+            N, order, alpha, n_common_neighbors+len(batch))
+        # make the multiple testing correction /n_common_neighbors
+        is_dependent = running_min > critical_corrs[
+            n_common_neighbors:n_common_neighbors+len(batch)]
+        if order_subsets:
+            # return the first independent set, unless the test would have
+            # declared n1 and n2 dependent before reaching it
+            with numpy.errstate(invalid='ignore'):
+                is_independent = scores <= critical_corrs[0]
+            if is_independent.any():
+                first_i = is_independent.argmax()
+                if is_dependent[:first_i].any():
+                    return None
+                return tuple(nodes[i] for i in batch[first_i])
+        if is_dependent.any():
+            return None
+
+        n_common_neighbors += len(batch)
+        if running_min[-1] < min_score:
+            min_score = running_min[-1]
+            best_i = numpy.nanargmin(scores)
+            best_neighbors = tuple(nodes[i] for i in batch[best_i])
+
+    return best_neighbors
+
+CI_TESTS = {
+    'lstsq': test_for_CI_lstsq,
+    'partial_corr': test_for_CI_partial_corr,
+    'fisher_z': test_for_CI_fisher_z
+}
+
+def test_for_CI(G, n1, n2, normalized_data, order, alpha, 
+                ci_test=None, order_subsets=None, n_samples=None):
+    """Test if n1 and n2 are conditionally independent. 
+
+    ci_test selects the backend from CI_TESTS, and defaults to CI_TEST.
+    order_subsets defaults to ORDER_CI_SUBSETS (see test_for_CI_lstsq for 
+    it and n_samples).
+
+    If they are not return None, else return the conditional independence set.
+    """
+    if ci_test is None: ci_test = CI_TEST
+    if order_subsets is None: order_subsets = ORDER_CI_SUBSETS
+    CI_TEST_COUNTERS['ci_tests'] += 1
+    return CI_TESTS[ci_test](
+        G, n1, n2, normalized_data, order, alpha, order_subsets, n_samples)
+
 def apply_pc_iteration_serial(G, normalized_data, order, alpha=ALPHA):    
     cond_independence_sets = defaultdict(set)
     
@@ -461,7 +1756,7 @@ def apply_pc_iteration_serial(G, normalized_data, order, alpha=ALPHA):
     num_nodes = len(G.nodes())
     for n1 in G.nodes():    
         n1_neighbors = sorted(
-            G.neighbors(n1), key=lambda n2: G[n1][n2]['marginal_p'])
+            G.succ[n1], key=lambda n2: G.edge_attr(n1, n2, 'marginal_p'))
         num_neighbors = len(n1_neighbors)
         if DEBUG_VERBOSE:
             print "Test O%i: %i/%i %i neighbors ... " % (
@@ -479,13 +1774,14 @@ def apply_pc_iteration_serial(G, normalized_data, order, alpha=ALPHA):
                 cond_independence_sets[(n1, n2)].update(are_CI)
                 G.remove_edge(n1, n2)
                 num_neighbors -= 1
-        if VERBOSE: 
-            print "%i remain (%i removed)" % (
-                num_neighbors, len(n1_neighbors) - num_neighbors)
+        record_pc_event('pc_node', order=order, node=n1, n_nodes=num_nodes,
+                        n_neighbors=len(n1_neighbors), 
+                        n_removed_edges=len(n1_neighbors) - num_neighbors)
     
     return cond_independence_sets
 
-def remove_edges_for_single_node(G, n1, normalized_data, order, alpha):
+def remove_edges_for_single_node(
+        G, n1, normalized_data, order, alpha, ci_test=None, n_samples=None):
     # the edges removed, and their corresponding conditional independence sets
     cond_independence_sets = defaultdict(set)
     
@@ -493,13 +1789,15 @@ def remove_edges_for_single_node(G, n1, normalized_data, order, alpha):
     # is order depedent, all else being equal we prefer to remove edges that 
     # have the lowest marginal correlation first
     n1_neighbors = sorted(
-        G.neighbors(n1), key=lambda n2: G[n1][n2]['marginal_p'])
+        G.succ[n1], key=lambda n2: G.edge_attr(n1, n2, 'marginal_p'))
     num_neighbors = len(n1_neighbors)
 
     for n2 in n1_neighbors:
         if n2 <= n1: continue
         if num_neighbors-1 <= order: break
-        are_CI = test_for_CI(G, n1, n2, normalized_data, order, alpha)
+        are_CI = test_for_CI(
+            G, n1, n2, normalized_data, order, alpha, ci_test, 
+            n_samples=n_samples)
         if are_CI == None:
             if DEBUG_VERBOSE: print "%i NOT CI of %i" % (n1, n2)
         else:
@@ -531,7 +1829,8 @@ def find_edges_to_remove(G, normalized_data, order, alpha=ALPHA):
 def partition_nodes_into_nonadjacent_sets(G):
     grouped_nodes = set()
     nodes_sets = []
-    degree_sorted_nodes = sorted(G.degree().items(), key=lambda x:-x[1])
+    degree_sorted_nodes = sorted(
+        ((node, G.degree(node)) for node in G.nodes()), key=lambda x:-x[1])
     while len(grouped_nodes) < len(G):
         nodes_sets.append( [] )
         remaining_nodes = set(G.nodes())
@@ -550,89 +1849,754 @@ def partition_nodes_into_nonadjacent_sets(G):
             remaining_nodes.difference_update(G.neighbors(node))
     return nodes_sets
 
-def find_CI_relationships_in_subprocess(
-        normalized_data, skeleton, ind_order, alpha,
-        node_set_queue, shared_edges_to_remove):
-    # make a thread local copy of the graph (shouldnt be necessary on
-    # a fork, but to be safe... )
-    curr_skeleton = skeleton.copy()
-    while True:
-        node = node_set_queue.get()
-        # if there are no nodes left, break
-        if node == None: break
-        node_CI_sets = remove_edges_for_single_node(
-            curr_skeleton, node, normalized_data, ind_order, alpha)
-        for edge, CI_set in node_CI_sets.iteritems():
-            shared_edges_to_remove.put((edge, CI_set))
+def shared_array(shape, dtype):
+    """Allocate a numpy array in shared memory.
+
+    The memory is an anonymous shared mapping, so processes forked after the
+    allocation read and write the same pages instead of copy-on-write copies.
+    """
+    dtype = numpy.dtype(dtype)
+    size = int(numpy.prod(shape))
+    raw = multiprocessing.sharedctypes.RawArray('b', max(1, size*dtype.itemsize))
+    return numpy.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+
+class PCWorkerPool(object):
+    """A persistent pool of forked processes that run the PC CI tests.
+
+    The workers are forked once per run. They read the normalized expression
+    matrix, and a CSR snapshot of the skeleton, from shared memory - each 
+    worker's skeleton is a CSRSkeleton over views of the shared arrays, so 
+    nothing is copied into the workers and the per process RSS doesn't 
+    grow with the number of workers. The workers disable the garbage 
+    collector, since a collection touches (and so un-shares) every object 
+    inherited from the parent.
+
+    Edges removed after the snapshot was taken are appended to a shared 
+    removal log. Each task is a tuple (node, order, alpha, delta_end, 
+    dispatch_time), and before running it a worker flags the log entries
+    up to delta_end in its skeleton's removed array, so dispatching a 
+    cluster only costs a queue put per node. apply_pc_order takes a new 
+    snapshot after every order, which keeps the log to a single order's 
+    removals. Results are streamed back as (node, CI sets) tuples.
+
+    A task's wait time is measured from the later of its dispatch and the 
+    end of the worker's previous task, so the time that the parent spends 
+    between clusters and orders (e.g. writing checkpoints) isn't counted.
+    """
+    def __init__(self, normalized_data, skeleton, 
+                 n_threads=N_THREADS, ci_test=None):
+        self.n_nodes = normalized_data.shape[0]
+        self.ci_test = ci_test
+        
+        self.normalized_data = shared_array(normalized_data.shape, float)
+        self.normalized_data[:] = normalized_data
+        # the skeleton only loses edges, so the initial size is an upper bound
+        # on both the snapshot size and the number of logged removals
+        n_edges = skeleton.number_of_edges()
+        self.indptr = shared_array((self.n_nodes+1,), 'int64')
+        self.indices = shared_array((2*n_edges,), 'int32')
+        self.marginal_p = shared_array((2*n_edges,), 'float32')
+        self.removed_edges = shared_array((n_edges, 2), 'int32')
+        self.n_removed_edges = 0
+        self.snapshot_version = multiprocessing.sharedctypes.RawValue('i', 0)
+        self.update_snapshot(skeleton)
+
+        self.stats = defaultdict(float)
+        self.task_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+        self.pids = [fork_worker(self._worker) for i in xrange(n_threads)]
+
+    def update_snapshot(self, skeleton):
+        """Write the CSRSkeleton skeleton into the shared CSR arrays (this 
+        compacts it), and clear the log.
+
+        This must only be called while no tasks are outstanding.
+        """
+        skeleton.compact()
+        n_entries = len(skeleton.indices)
+        self.indptr[:] = skeleton.indptr
+        self.indices[:n_entries] = skeleton.indices
+        self.marginal_p[:n_entries] = skeleton.attrs['marginal_p']
+        self.n_removed_edges = 0
+        self.snapshot_version.value += 1
+
+    def log_removed_edges(self, edges):
+        """Tell the workers that edges were removed from the skeleton.
+
+        This must only be called while no tasks are outstanding.
+        """
+        for n1, n2 in edges:
+            self.removed_edges[self.n_removed_edges] = (n1, n2)
+            self.n_removed_edges += 1
+        return
+
+    def _load_snapshot(self):
+        n_entries = int(self.indptr[-1])
+        return CSRSkeleton(
+            range(self.n_nodes), self.indptr, self.indices[:n_entries], 
+            marginal_p=self.marginal_p[:n_entries])
+
+    def _worker(self):
+        gc.disable()
+        curr_version, curr_skeleton, n_applied = None, None, 0
+        while True:
+            wait_start_time = time.time()
+            task = self.task_queue.get()
+            # the pool is being closed
+            if task is None: break
+            node, order, alpha, delta_end, dispatch_time = task
+            start_time = time.time()
+            CI_TEST_COUNTERS.clear()
+            try:
+                if curr_version != self.snapshot_version.value:
+                    curr_version = self.snapshot_version.value
+                    curr_skeleton = self._load_snapshot()
+                    n_applied = 0
+                # apply the adjacency delta
+                for n1, n2 in self.removed_edges[n_applied:delta_end].tolist():
+                    curr_skeleton.remove_edge(n1, n2)
+                n_applied = max(n_applied, delta_end)
+                node_CI_sets = remove_edges_for_single_node(
+                    curr_skeleton, node, self.normalized_data, 
+                    order, alpha, self.ci_test)
+                stats = dict(CI_TEST_COUNTERS)
+                stats['wait_time'] = start_time - max(
+                    wait_start_time, dispatch_time)
+                stats['busy_time'] = time.time() - start_time
+                self.result_queue.put((node, dict(node_CI_sets), stats))
+            except Exception:
+                self.result_queue.put((node, traceback.format_exc(), None))
+        return
+
+    def iter_CI_relationships(self, nodes, order, alpha):
+        """Find the CI edges for every node in nodes.
+
+        Yields (node, CI sets) tuples in the order that the workers 
+        finish them, where CI sets maps the removed edges to their CI sets.
+        The workers' CI test counts and busy/queue wait times are summed 
+        into self.stats. A RuntimeError is raised if a worker fails or dies.
+        """
+        for node in nodes: 
+            self.task_queue.put(
+                (node, order, alpha, self.n_removed_edges, time.time()))
+        for i in xrange(len(nodes)):
+            node, node_CI_sets, stats = get_worker_result(
+                self.result_queue, self.pids)
+            if not isinstance(node_CI_sets, dict):
+                raise RuntimeError(
+                    "PC worker failed on node %i:\n%s" % (node, node_CI_sets))
+            for key, val in stats.iteritems():
+                self.stats[key] += val
+            yield node, node_CI_sets
+        return
+
+    def find_CI_relationships(self, nodes, order, alpha):
+        """Find the CI edges for every node in nodes.
+
+        Returns a dict mapping the removed edges to their CI sets.
+        """
+        cond_independence_sets = {}
+        for node, node_CI_sets in self.iter_CI_relationships(
+                nodes, order, alpha):
+            cond_independence_sets.update(node_CI_sets)
+        return cond_independence_sets
+
+    def close(self, terminate=False):
+        if not terminate:
+            for pid in self.pids: 
+                self.task_queue.put(None)
+        stop_workers(self.pids, terminate)
+        self.pids = []
+        return
+
+def hash_expression_matrix(normalized_data):
+    """Return a hex digest identifying the normalized expression matrix."""
+    normalized_data = numpy.ascontiguousarray(normalized_data, dtype=float)
+    hasher = hashlib.sha1()
+    hasher.update(str(normalized_data.shape))
+    hasher.update(normalized_data.tostring())
+    return hasher.hexdigest()
+
+def skeleton_from_edge_arrays(labels, src, dst, corr, marginal_p):
+    return CSRSkeleton.from_edge_arrays(
+        labels, src, dst, corr=corr, marginal_p=marginal_p)
+
+# the run settings that are stored in a checkpoint, and that a resumed run
+# must match
+PC_CHECKPOINT_SETTINGS = ('alpha', 'ci_test', 'stable', 'order_subsets')
+
+def pc_run_settings(alpha, ci_test=None, stable=None, order_subsets=None):
+    """Return the PC_CHECKPOINT_SETTINGS of a run, with the defaults filled in.
+    """
+    return { 'alpha': float(alpha), 
+             'ci_test': CI_TEST if ci_test is None else ci_test,
+             'stable': bool(STABLE_PC if stable is None else stable),
+             'order_subsets': bool(
+                 ORDER_CI_SUBSETS if order_subsets is None else order_subsets) }
+
+def write_pc_checkpoint(fname, graph_fname, skeleton, cond_independence_sets,
+                        order, settings, data_hash):
+    """Write the separating sets after order to fname.
+
+    The skeleton's edges aren't stored again - the checkpoint references
+    graph_fname, which must hold the skeleton written by write_graph (the 
+    path is stored relative to the checkpoint's directory), and records its
+    number of edges so that a mismatched graph file is detected on load. 
+    settings are the run's settings, as returned by pc_run_settings. The 
+    separating sets are stored in CSR form - the members of the set for
+    edge (ci_src[i], ci_dst[i]) are ci_members[ci_indptr[i]:ci_indptr[i+1]].
+    The file is written to a temporary file and then moved into place, so 
+    a crash never leaves a truncated checkpoint.
+    """
+    ci_edges = sorted(cond_independence_sets)
+    ci_indptr = numpy.zeros(len(ci_edges)+1, dtype='int64')
+    ci_members = []
+    for i, edge in enumerate(ci_edges):
+        members = sorted(cond_independence_sets[edge])
+        ci_indptr[i+1] = ci_indptr[i] + len(members)
+        ci_members.extend(members)
+    
+    tmp_fname = fname + ".tmp"
+    with open(tmp_fname, "wb") as ofp:
+        numpy.savez(
+            ofp, order=order, data_hash=data_hash, n_nodes=len(skeleton),
+            alpha=settings['alpha'], ci_test=settings['ci_test'], 
+            stable=settings['stable'], order_subsets=settings['order_subsets'],
+            graph_fname=os.path.relpath(
+                graph_fname, os.path.dirname(os.path.abspath(fname))),
+            n_edges=skeleton.number_of_edges(),
+            ci_src=numpy.array([x[0] for x in ci_edges], dtype='int32'),
+            ci_dst=numpy.array([x[1] for x in ci_edges], dtype='int32'),
+            ci_indptr=ci_indptr,
+            ci_members=numpy.array(ci_members, dtype='int32'))
+    os.rename(tmp_fname, fname)
     return
 
-def estimate_pdag(sample1, sample2, labels, alpha=ALPHA):
-    # combine and normalize the samples
-    normalized_data = numpy.hstack((sample1, sample2))
-    normalized_data = ((normalized_data.T)/(normalized_data.sum(1))).T
+def load_pc_checkpoint(fname, labels, data_hash=None):
+    """Load a checkpoint written by write_pc_checkpoint, and the skeleton 
+    from the graph file that it references.
+
+    Returns the order, run settings, skeleton and separating sets. If 
+    data_hash is set, raise a ValueError if it doesn't match the checkpoint's
+    hash.
+    """
+    with numpy.load(fname) as data:
+        missing = [key for key in PC_CHECKPOINT_SETTINGS 
+                   if key not in data.files]
+        if len(missing) > 0:
+            raise ValueError(
+                "The checkpoint '%s' doesn't record the run's %s" % (
+                    fname, ", ".join(missing)))
+        settings = pc_run_settings(
+            float(data['alpha']), str(data['ci_test']), 
+            bool(data['stable']), bool(data['order_subsets']))
+        if data_hash is not None and str(data['data_hash']) != data_hash:
+            raise ValueError(
+                "The checkpoint '%s' was built from a different expression matrix" % fname)
+        if int(data['n_nodes']) != len(labels):
+            raise ValueError(
+                "The checkpoint '%s' has %i nodes, but there are %i labels" % (
+                    fname, int(data['n_nodes']), len(labels)))
+        graph_fname = os.path.join(
+            os.path.dirname(os.path.abspath(fname)), str(data['graph_fname']))
+        arrays = load_graph_arrays(graph_fname)
+        if ( len(arrays['labels']) != len(labels) 
+             or len(arrays['src']) != int(data['n_edges']) ):
+            raise ValueError(
+                "The graph '%s' doesn't hold the skeleton of checkpoint '%s'"
+                % (graph_fname, fname))
+        skeleton = skeleton_from_edge_arrays(
+            labels, arrays['src'], arrays['dst'], arrays['attr_corr'], 
+            arrays['attr_marginal_p'])
+        cond_independence_sets = {}
+        ci_indptr, ci_members = data['ci_indptr'], data['ci_members']
+        for i, edge in enumerate(zip(
+                data['ci_src'].tolist(), data['ci_dst'].tolist())):
+            cond_independence_sets[edge] = set(
+                ci_members[ci_indptr[i]:ci_indptr[i+1]].tolist())
+        return ( int(data['order']), settings, 
+                 skeleton, cond_independence_sets )
+
+# the first bytes of a zstd frame
+ZSTD_MAGIC = '\x28\xb5\x2f\xfd'
+
+def graph_to_arrays(G):
+    """Return the binary edge list arrays of the CompactGraph (or 
+    CSRSkeleton) G.
+
+    Every adjacency is stored once, as (src, dst, directed): src->dst if 
+    directed is set, and the undirected edge src--dst otherwise. Every edge
+    attribute is stored as a float column 'attr_<name>' (nan if missing).
+    """
+    if isinstance(G, CSRSkeleton):
+        src, dst, attrs = G.edge_arrays()
+        arrays = {'labels': numpy.array(G.labels), 
+                  'src': src, 'dst': dst, 
+                  'directed': numpy.zeros(len(src), dtype=bool)}
+        for name, values in attrs.iteritems():
+            arrays['attr_' + name] = values.astype(float)
+        return arrays
+    adjacencies = G.edges()
+    src = numpy.zeros(len(adjacencies), dtype='int32')
+    dst = numpy.zeros(len(adjacencies), dtype='int32')
+    directed = numpy.zeros(len(adjacencies), dtype=bool)
+    for i, (a, b) in enumerate(adjacencies):
+        if G.has_edge(a, b):
+            src[i], dst[i], directed[i] = a, b, not G.has_edge(b, a)
+        else:
+            src[i], dst[i], directed[i] = b, a, True
     
-    skeleton = estimate_initial_skeleton(
-        normalized_data, labels, alpha=alpha)
-    nx.write_gml(skeleton, "skeleton_O0.gml")
+    arrays = {'labels': numpy.array(G.labels), 
+              'src': src, 'dst': dst, 'directed': directed}
+    attr_names = sorted(set(
+        name for data in G.edge_data.itervalues() for name in data))
+    for name in attr_names:
+        arrays['attr_' + name] = numpy.array(
+            [G.edge_data[key].get(name, numpy.nan) for key in adjacencies],
+            dtype=float)
+    return arrays
+
+def write_graph(fname, G, compress=None):
+    """Write the graph G as a binary edge list (see graph_to_arrays).
+
+    The arrays are stored in an npz file. If compress is set (it defaults 
+    to COMPRESS_GRAPHS) the file is zstd compressed when zstandard is 
+    installed, and zlib compressed (savez_compressed) otherwise. 
+    """
+    if compress is None: compress = COMPRESS_GRAPHS
+    arrays = graph_to_arrays(G)
+    tmp_fname = fname + ".tmp"
+    with open(tmp_fname, "wb") as ofp:
+        if compress and zstandard is not None:
+            # zipfile needs a seekable file, so compress the finished npz
+            buf = StringIO()
+            numpy.savez(buf, **arrays)
+            ofp.write(zstandard.ZstdCompressor().compress(buf.getvalue()))
+        elif compress:
+            numpy.savez_compressed(ofp, **arrays)
+        else:
+            numpy.savez(ofp, **arrays)
+    os.rename(tmp_fname, fname)
+    return
 
-    cond_independence_sets = {}
-    for ind_order in xrange(1,min(MAX_ORDER,min(normalized_data.shape)-2+1)):
-        nonadjacent_node_sets = partition_nodes_into_nonadjacent_sets(skeleton)
-        print "O%i: Processing cluster %i/%i: %i/%i nodes remain" % (
-            ind_order, 1, len(nonadjacent_node_sets),
-            sum(len(x) for i, x in enumerate(nonadjacent_node_sets) 
-                if i >= 0),
-            sum(len(x) for x in nonadjacent_node_sets))
-
-        for cluster_i, nonadjacent_nodes in enumerate(nonadjacent_node_sets):
-            new_cond_independence_sets = multiprocessing.Queue()
-            # populate the queue
-            n_threads_to_spawn = min(N_THREADS, len(nonadjacent_nodes))
-            nodes_queue = multiprocessing.Queue()
-            for node in nonadjacent_nodes: nodes_queue.put(node)
-            for i in xrange(n_threads_to_spawn): nodes_queue.put(None)
-
-            # spaqwn worker processes
-            pids = []
-            for i in xrange(n_threads_to_spawn):
-                pid = os.fork()
-                if pid == 0:
-                    find_CI_relationships_in_subprocess(
-                        normalized_data, skeleton, ind_order, alpha, 
-                        nodes_queue, new_cond_independence_sets)
-                    os._exit(0)
-                else:
-                    pids.append(pid)
-            try:
-                for pid in pids:
-                    os.waitpid(pid, 0)
-            except:
-                for pid in pids:
-                    os.kill(pid, signal.SIGTERM)
-                raise
-            print "O%i: Finished processing cluster %i/%i: %i/%i nodes remain" % (
-                ind_order, cluster_i+1, len(nonadjacent_node_sets),
-                sum(len(x) for i, x in enumerate(nonadjacent_node_sets) 
-                    if i > cluster_i),
-                sum(len(x) for x in nonadjacent_node_sets))
-            
-            # update the global cond_independence_sets
-            while not new_cond_independence_sets.empty():
-                edge, CI_set = new_cond_independence_sets.get()
-                assert edge not in cond_independence_sets
-                cond_independence_sets[edge] = CI_set
-                skeleton.remove_edge(*edge)
+def load_graph_arrays(fname):
+    """Load the arrays of a binary edge list written by write_graph.
+
+    Returns a dict of numpy arrays - see graph_to_arrays.
+    """
+    with open(fname, "rb") as fp:
+        if fp.read(4) == ZSTD_MAGIC:
+            if zstandard is None:
+                raise ImportError(
+                    "'%s' is zstd compressed, but zstandard isn't installed" 
+                    % fname)
+            fp.seek(0)
+            data = StringIO(zstandard.ZstdDecompressor().decompress(fp.read()))
+        else:
+            fp.seek(0)
+            data = StringIO(fp.read())
+    with numpy.load(data) as npz:
+        return dict((key, npz[key]) for key in npz.files)
+
+def load_graph(fname):
+    """Load a binary edge list written by write_graph as a CompactGraph."""
+    arrays = load_graph_arrays(fname)
+    G = CompactGraph(arrays['labels'].tolist())
+    attr_names = sorted(key for key in arrays if key.startswith('attr_'))
+    for i, (a, b, directed) in enumerate(zip(
+            arrays['src'].tolist(), arrays['dst'].tolist(), 
+            arrays['directed'].tolist())):
+        G.add_arc(a, b)
+        if not directed: G.add_arc(b, a)
+        G.edge_data[(min(a, b), max(a, b))] = dict(
+            (name[len('attr_'):], float(arrays[name][i])) 
+            for name in attr_names 
+            if not numpy.isnan(arrays[name][i]))
+    return G
 
-        print "Writing O%i skeleton to disk" % ind_order        
-        nx.write_gml(skeleton, "skeleton_O%i.gml" % ind_order)
+def gml_key(name):
+    """Return the GML key of an attribute name - GML keys are alphanumeric,
+    so e.g. marginal_p is written as marginalP.
+    """
+    words = [x for x in re.split('[^0-9A-Za-z]+', name) if x != '']
+    return words[0] + "".join(x[:1].upper() + x[1:] for x in words[1:])
 
+def export_graph(fname, ofname):
+    """Convert a binary edge list into GML or GEXF (chosen by ofname's 
+    extension, .gml or .gexf) - a post processing step for visualization 
+    tools.
+
+    GML keys can't contain underscores, so the GML attribute names are 
+    converted with gml_key, and write_gml labels the nodes with their ids,
+    so the GML nodes are the gene labels. GEXF keeps the attribute names.
+    """
+    G = load_graph(fname).to_networkx()
+    if ofname.endswith(".gexf"):
+        nx.write_gexf(G, ofname)
+    elif ofname.endswith(".gml"):
+        G = nx.relabel_nodes(G, dict(
+            (node, data.pop('label')) for node, data in G.nodes(data=True)))
+        for a, b, data in G.edges(data=True):
+            for name in data.keys():
+                data[gml_key(name)] = data.pop(name)
+        nx.write_gml(G, ofname)
+    else:
+        raise ValueError(
+            "Can't export '%s' - the formats are .gml and .gexf" % ofname)
+    return
+
+def normalize_samples(sample1, sample2):
+    """Combine the samples, and normalize every gene to sum to 1."""
+    normalized_data = numpy.hstack((sample1, sample2))
+    return ((normalized_data.T)/(normalized_data.sum(1))).T
+
+def apply_pc_order(skeleton, pool, ind_order, alpha, 
+                   cond_independence_sets, stable=None):
+    """Remove the skeleton edges that are CI given ind_order neighbors.
+
+    The separating sets of the removed edges are added to 
+    cond_independence_sets. If stable is set (it defaults to STABLE_PC) 
+    then every node is tested against the skeleton from the start of the 
+    order - all nodes are tested in parallel and the removed edges are 
+    applied at the end of the order. This makes the result independent of 
+    the node processing order and the number of workers. Otherwise the 
+    nodes are processed in clusters of non-adjacent nodes, and each cluster 
+    sees the edges removed by the previous ones. 
+    
+    Records a 'pc_cluster' event for every cluster and a 'pc_order' event 
+    for the order, and returns the number of removed edges.
+    """
+    if stable is None: stable = STABLE_PC
+    order_start_time = time.time()
+    if stable:
+        # a single batch, so all removals happen at the end of the order
+        nonadjacent_node_sets = [sorted(skeleton.nodes()),]
+    else:
+        nonadjacent_node_sets = partition_nodes_into_nonadjacent_sets(
+            skeleton)
+    n_nodes = sum(len(x) for x in nonadjacent_node_sets)
+    record_pc_event('pc_order_start', order=ind_order, n_nodes=n_nodes,
+                    n_clusters=len(nonadjacent_node_sets))
+    
+    order_stats = defaultdict(float)
+    n_removed = 0
+    for cluster_i, nonadjacent_nodes in enumerate(nonadjacent_node_sets):
+        start_time = time.time()
+        pool.stats.clear()
+        new_cond_independence_sets = pool.find_CI_relationships(
+            nonadjacent_nodes, ind_order, alpha)
+        elapsed = time.time() - start_time
+        for key, val in pool.stats.iteritems():
+            order_stats[key] += val
+        record_pc_event(
+            'pc_cluster', order=ind_order, cluster=cluster_i, 
+            n_clusters=len(nonadjacent_node_sets), 
+            n_cluster_nodes=len(nonadjacent_nodes), n_nodes=n_nodes,
+            n_remaining_nodes=sum(len(x) for x in 
+                                  nonadjacent_node_sets[cluster_i+1:]),
+            n_removed_edges=len(new_cond_independence_sets),
+            elapsed=elapsed,
+            ci_tests=int(pool.stats['ci_tests']),
+            conditioning_sets=int(pool.stats['conditioning_sets']),
+            worker_busy_time=pool.stats['busy_time'],
+            worker_wait_time=pool.stats['wait_time'],
+            worker_utilization=(
+                pool.stats['busy_time']/(elapsed*len(pool.pids)) 
+                if elapsed > 0 and len(pool.pids) > 0 else None))
+        
+        # update the global cond_independence_sets
+        for edge, CI_set in sorted(new_cond_independence_sets.items()):
+            assert edge not in cond_independence_sets
+            cond_independence_sets[edge] = CI_set
+            skeleton.remove_edge(*edge)
+        pool.log_removed_edges(sorted(new_cond_independence_sets))
+        n_removed += len(new_cond_independence_sets)
+    # compact the skeleton, and restart the workers' removal logs from it
+    pool.update_snapshot(skeleton)
+    
+    record_pc_event(
+        'pc_order', order=ind_order, n_removed_edges=n_removed, 
+        n_edges=skeleton.number_of_edges(), 
+        elapsed=time.time()-order_start_time,
+        ci_tests=int(order_stats['ci_tests']),
+        conditioning_sets=int(order_stats['conditioning_sets']),
+        lstsq_fallbacks=int(order_stats['lstsq_fallbacks']),
+        worker_busy_time=order_stats['busy_time'],
+        worker_wait_time=order_stats['wait_time'])
+    return n_removed
+
+def estimate_pdag(sample1, sample2, labels, alpha=ALPHA, stable=None, 
+                  resume_from=None, ci_test=None):
+    """Estimate the PDAG of the samples with the PC algorithm.
+
+    A checkpoint (PC_CHECKPOINT_FNAME) is written after every order. If 
+    resume_from is set to one of these checkpoints, the run picks up at the
+    order after the checkpoint's. See apply_pc_order for stable, and 
+    test_for_CI for ci_test.
+    """
+    normalized_data = normalize_samples(sample1, sample2)
+    data_hash = hash_expression_matrix(normalized_data)
+    settings = pc_run_settings(alpha, ci_test, stable)
     
-    est_G = skeleton.to_directed()
+    if resume_from is None:
+        skeleton = estimate_initial_skeleton(
+            normalized_data, labels, alpha=alpha)
+        write_graph(SKELETON_FNAME % 0, skeleton)
+        cond_independence_sets = {}
+        write_pc_checkpoint(PC_CHECKPOINT_FNAME % 0, SKELETON_FNAME % 0,
+            skeleton, cond_independence_sets, 0, settings, data_hash)
+        start_order = 1
+    else:
+        record_pc_event('resume', fname=resume_from)
+        ckpt_order, ckpt_settings, skeleton, cond_independence_sets = \
+            load_pc_checkpoint(resume_from, labels, data_hash)
+        for key in PC_CHECKPOINT_SETTINGS:
+            if ckpt_settings[key] != settings[key]:
+                raise ValueError(
+                    "The checkpoint '%s' was built with %s=%s, not %s" % (
+                        resume_from, key, ckpt_settings[key], settings[key]))
+        start_order = ckpt_order + 1
+
+    pool = PCWorkerPool(
+        normalized_data, skeleton, ci_test=settings['ci_test'])
+    try:
+        for ind_order in xrange(
+                start_order, min(MAX_ORDER,min(normalized_data.shape)-2+1)):
+            apply_pc_order(skeleton, pool, ind_order, alpha, 
+                           cond_independence_sets, settings['stable'])
+            record_pc_event('checkpoint', order=ind_order)
+            write_graph(SKELETON_FNAME % ind_order, skeleton)
+            write_pc_checkpoint(PC_CHECKPOINT_FNAME % ind_order, 
+                SKELETON_FNAME % ind_order, skeleton, cond_independence_sets, ind_order, settings, 
+                data_hash)
+    except:
+        pool.close(terminate=True)
+        raise
+    else:
+        pool.close()
+    
+    est_G = skeleton.to_compact_graph()
     orient_v_structures(est_G, cond_independence_sets)
-    applied_rule = True
-    while apply_IC_rules(est_G): pass
+    propagate_orientations(est_G)
     return est_G, cond_independence_sets
 
+def resume_pdag(checkpoint_fname, sample1, sample2, labels, 
+                stable=None, ci_test=None):
+    """Resume an estimate_pdag run from a checkpoint.
+
+    The alpha, and stable and ci_test unless they are set, are taken from 
+    the checkpoint. The samples must be the ones that the checkpoint was 
+    built from.
+    """
+    with numpy.load(checkpoint_fname) as data:
+        alpha = float(data['alpha'])
+        if stable is None and 'stable' in data.files: 
+            stable = bool(data['stable'])
+        if ci_test is None and 'ci_test' in data.files: 
+            ci_test = str(data['ci_test'])
+    return estimate_pdag(sample1, sample2, labels, alpha=alpha, 
+                         stable=stable, resume_from=checkpoint_fname,
+                         ci_test=ci_test)
+
+def estimate_skeleton_serial(normalized_data, labels, alpha, tps, 
+                             max_order=MAX_ORDER, ci_test=None):
+    """Estimate the PC skeleton of the timepoints tps in this process, 
+    without any workers.
+
+    Timepoint k is column k of the first replicate, and column n_tps+k of 
+    the second, and both O0 and the CI tests only see the columns of tps. 
+    tps may repeat timepoints (a bootstrap draw) - the repeated columns are 
+    kept, but the p-values use the number of distinct timepoints, so that
+    repeats don't make the correlations look more significant.
+    """
+    n_tps = normalized_data.shape[1]//2
+    tps = numpy.asarray(tps)
+    n_distinct = len(numpy.unique(tps))
+    data = normalized_data[:,numpy.concatenate((tps, tps+n_tps))]
+    skeleton = estimate_initial_skeleton(
+        data, labels, alpha, numpy.arange(len(tps)), 
+        numpy.arange(len(tps), 2*len(tps)), n_threads=1, n_samples=n_distinct)
+    for ind_order in xrange(
+            1, min(max_order, min(data.shape[0], 2*n_distinct)-2+1)):
+        for node in skeleton.nodes():
+            node_CI_sets = remove_edges_for_single_node(
+                skeleton, node, data, ind_order, alpha, ci_test, 
+                n_samples=2*n_distinct)
+            for n1, n2 in node_CI_sets:
+                skeleton.remove_edge(n1, n2)
+    return skeleton
+
+# the fewest distinct timepoints that a resampled replicate can have - a 
+# correlation of fewer has no degrees of freedom
+MIN_RESAMPLED_TPS = 3
+
+def resample_replicate_columns(random_state, n_tps, method, subsample_size):
+    """Return the resampled timepoint indices of one stability replicate.
+
+    Timepoint k is column k of both replicate groups, and the pairing is 
+    kept so that the cross replicate correlations stay meaningful. Bootstrap
+    draws with fewer than MIN_RESAMPLED_TPS distinct timepoints are redrawn.
+    The 'genes' method resamples the genes instead, so it keeps every 
+    timepoint.
+    """
+    if n_tps < MIN_RESAMPLED_TPS:
+        raise ValueError("Can't resample %i timepoints (the minimum is %i)" % (
+            n_tps, MIN_RESAMPLED_TPS))
+    if method == 'bootstrap':
+        while True:
+            tps = random_state.randint(0, n_tps, n_tps)
+            if len(numpy.unique(tps)) >= MIN_RESAMPLED_TPS: 
+                return tps
+    elif method == 'subsample':
+        if not MIN_RESAMPLED_TPS <= subsample_size <= n_tps:
+            raise ValueError(
+                "The subsample size must be between %i and %i, not %s" % (
+                    MIN_RESAMPLED_TPS, n_tps, subsample_size))
+        return numpy.sort(random_state.permutation(n_tps)[:subsample_size])
+    elif method == 'genes':
+        return numpy.arange(n_tps)
+    raise ValueError("Unrecognized resampling method '%s'" % method)
+
+def resample_replicate_genes(random_state, n_genes, method, gene_fraction):
+    """Return the sorted gene indices of one stability replicate - every 
+    gene, unless method is 'genes', which draws gene_fraction of them (at 
+    least two) without replacement.
+    """
+    if method != 'genes':
+        return numpy.arange(n_genes)
+    n_drawn = max(2, int(round(gene_fraction*n_genes)))
+    return numpy.sort(random_state.permutation(n_genes)[:n_drawn])
+
+def find_edge_indices(candidate_keys, n_nodes, edges):
+    """Return the positions in candidate_keys (the sorted src*n_nodes+dst 
+    keys of the candidate edges) of the edges (a, b) with a < b that are 
+    candidates.
+    """
+    edges = numpy.array(edges, dtype='int64').reshape(-1, 2)
+    keys = edges[:,0]*n_nodes + edges[:,1]
+    indices = numpy.searchsorted(candidate_keys, keys)
+    is_candidate = indices < len(candidate_keys)
+    is_candidate[is_candidate] = (
+        candidate_keys[indices[is_candidate]] == keys[is_candidate])
+    return indices[is_candidate]
+
+def _run_stability_replicate(
+        normalized_data, labels, alpha, candidate_keys, counts, 
+        sampled_counts, counts_lock, method, subsample_size, gene_fraction, 
+        seed, replicate):
+    """Run one stability replicate, and add its edges to counts, and the 
+    candidate edges whose genes it drew to sampled_counts.
+
+    Returns the number of edges and the run time.
+    """
+    # only the parent reports progress
+    del PC_EVENT_CALLBACKS[:]
+    start_time = time.time()
+    n_tps = normalized_data.shape[1]//2
+    random_state = numpy.random.RandomState(
+        None if seed is None else seed + replicate)
+    tps = resample_replicate_columns(
+        random_state, n_tps, method, subsample_size)
+    genes = resample_replicate_genes(
+        random_state, len(labels), method, gene_fraction)
+    skeleton = estimate_skeleton_serial(
+        normalized_data[genes], [labels[i] for i in genes], alpha, tps)
+    # genes is sorted, so the edges keep src < dst
+    edges = numpy.array(skeleton.edges(), dtype='int64').reshape(-1, 2)
+    indices = find_edge_indices(candidate_keys, len(labels), genes[edges])
+    is_drawn = numpy.zeros(len(labels), dtype=bool)
+    is_drawn[genes] = True
+    is_sampled = ( is_drawn[candidate_keys//len(labels)] 
+                   & is_drawn[candidate_keys%len(labels)] )
+    with counts_lock:
+        counts[indices] += 1
+        sampled_counts[is_sampled] += 1
+    return skeleton.number_of_edges(), time.time() - start_time
+
+def estimate_stable_skeleton(
+        sample1, sample2, labels, n_replicates=100, method=None, 
+        subsample_size=None, gene_fraction=STABILITY_GENE_FRACTION,
+        threshold=STABILITY_THRESHOLD, alpha=ALPHA, n_threads=N_THREADS, 
+        seed=None):
+    """Estimate the skeleton by stability selection over PC runs.
+
+    Every replicate resamples the data and runs the PC skeleton search on 
+    it (see estimate_skeleton_serial). 'bootstrap' draws n_tps timepoints
+    with replacement, and 'subsample' draws subsample_size (by default half
+    of the timepoints) without. Resampling the timepoints needs more than 
+    MIN_RESAMPLED_TPS of them - with that few, every valid draw is the full
+    data set. 'genes' keeps every timepoint and draws gene_fraction of the 
+    genes, which changes the conditioning sets that the CI tests can use, 
+    so it also works on MIN_RESAMPLED_TPS timepoints. method defaults to 
+    'bootstrap', or 'genes' when there are too few timepoints. 
+
+    The replicates run concurrently in n_threads forked workers 
+    (run_forked_workers), which share one copy of the normalized data. Each
+    finished replicate adds its edges to a shared counter array over the 
+    candidate edges - the O0 edges of the full data - and counts the 
+    candidate edges that it sampled (both genes drawn). An edge's selection
+    frequency is the fraction of the replicates that sampled it which 
+    selected it.
+
+    Returns the consensus skeleton - the candidate edges selected by at 
+    least threshold of the replicates, with a 'selection_frequency' 
+    attribute - and the selection frequency of every candidate edge.
+    """
+    normalized_data = normalize_samples(sample1, sample2)
+    n_tps = sample1.shape[1]
+    if method is None:
+        method = 'bootstrap' if n_tps > MIN_RESAMPLED_TPS else 'genes'
+    if method not in ('bootstrap', 'subsample', 'genes'):
+        raise ValueError("Unrecognized resampling method '%s'" % method)
+    if n_tps < MIN_RESAMPLED_TPS or (
+            method != 'genes' and n_tps == MIN_RESAMPLED_TPS):
+        raise ValueError(
+            "Stability selection by '%s' needs more than %i timepoints, "
+            "not %i" % (method, MIN_RESAMPLED_TPS - (method == 'genes'), 
+                        n_tps))
+    if method == 'genes' and not 0 < gene_fraction <= 1:
+        raise ValueError(
+            "The gene fraction must be in (0, 1], not %s" % gene_fraction)
+    if subsample_size is None: 
+        subsample_size = max(MIN_RESAMPLED_TPS, n_tps//2)
+    if method == 'subsample' and not (
+            MIN_RESAMPLED_TPS <= subsample_size < n_tps):
+        raise ValueError(
+            "The subsample size must be between %i and %i, not %s" % (
+                MIN_RESAMPLED_TPS, n_tps-1, subsample_size))
+    shared_data = shared_array(normalized_data.shape, float)
+    shared_data[:] = normalized_data
+    
+    src, dst, corr, marginal_p = find_marginal_correlation_edges(
+        shared_data, alpha, numpy.arange(n_tps), numpy.arange(n_tps, 2*n_tps),
+        n_threads)
+    candidate_keys = src.astype('int64')*len(labels) + dst
+    order = numpy.argsort(candidate_keys)
+    src, dst, corr, marginal_p, candidate_keys = (
+        src[order], dst[order], corr[order], marginal_p[order], 
+        candidate_keys[order])
+    counts = shared_array((len(candidate_keys),), 'int32')
+    sampled_counts = shared_array((len(candidate_keys),), 'int32')
+    counts_lock = multiprocessing.Lock()
+    
+    for i, (replicate, (n_edges, elapsed)) in enumerate(run_forked_workers(
+            lambda replicate: _run_stability_replicate(
+                shared_data, labels, alpha, candidate_keys, counts, 
+                sampled_counts, counts_lock, method, subsample_size, 
+                gene_fraction, seed, replicate),
+            xrange(n_replicates), n_threads)):
+        record_pc_event('stability_replicate', replicate=replicate, 
+                        n_finished=i+1, n_replicates=n_replicates, 
+                        n_edges=n_edges, elapsed=elapsed)
+    
+    frequencies = counts.astype(float)/numpy.maximum(sampled_counts, 1)
+    selected = frequencies >= threshold
+    consensus = CSRSkeleton.from_edge_arrays(
+        labels, src[selected], dst[selected], corr=corr[selected], 
+        marginal_p=marginal_p[selected], 
+        selection_frequency=frequencies[selected])
+    return consensus, frequencies
+
 def hierarchical_layout(real_G):
     level_grouped_nodes = defaultdict(list)
     for node, data in real_G.nodes(data=True):
@@ -648,7 +2612,7 @@ def hierarchical_layout(real_G):
     return pos
 
 def iter_all_subsets_of_siblings(G, node):
-    siblings = set(nx.all_neighbors(G, node))
+    siblings = G.neighbors(node)
     for i in xrange(1, len(siblings)+1):
         for subset in combinations(siblings, i):
             yield subset
@@ -657,16 +2621,16 @@ def iter_all_subsets_of_siblings(G, node):
 def brute_force_find_all_consistent_dags(pdag, data):
     def get_undirected_edges(G):
         undirected_edges = []
-        for a, b in G.edges():
+        for a, b in G.arcs():
             if G.has_edge(b, a):
                 undirected_edges.append( (a,b) )
         return undirected_edges
     
     def orient_edge_and_propogate_changes(G, a, b):
         G = G.copy()
-        G.remove_edge(b, a)
+        G.remove_arc(b, a)
         #orient_v_structures(G, data)
-        while apply_IC_rules(G): pass
+        propagate_orientations(G, iter_affected_edges(G, a, b))
         return G
 
     # the dags that we've found
@@ -681,8 +2645,8 @@ def brute_force_find_all_consistent_dags(pdag, data):
         # if there are no more edges to orient, then make sure that we haven't 
         # already seen it and that it is acyclic, and add it
         if len(edges_to_orient) == 0: 
-            if (not any(set(curr_pdag.edges()) == set(x.edges()) for x in dags)
-                    and nx.is_directed_acyclic_graph(curr_pdag)):
+            if (not any(set(curr_pdag.arcs()) == set(x.arcs()) for x in dags)
+                    and curr_pdag.is_acyclic()):
                 dags.append(curr_pdag)
         else:
             for a, b in edges_to_orient:
@@ -692,56 +2656,149 @@ def brute_force_find_all_consistent_dags(pdag, data):
     return dags
 
 
-def find_all_consistent_dags(pdag, cond_independence_sets, real_G):
-    initial_colliders = set(iter_colliders(pdag))
-    
-    def get_undirected_edges(G):
-        undirected_edges = []
-        for a, b in G.edges():
-            if G.has_edge(b, a):
-                undirected_edges.append( (a,b) )
-        return undirected_edges
-    
-    def orient_edge_and_propogate_changes(G, a, b):
-        G = G.copy()
-        G.remove_edge(b, a)
-        orient_v_structures(G, cond_independence_sets)
-        while apply_IC_rules(G): pass
-        # make sure that the resulting graph is acyclic
-        #if not nx.is_directed_acyclic_graph(G): return None
-        if any( collider not in initial_colliders 
-                for collider in  iter_colliders(G) ): 
-            return None
-        return G
+def find_chain_components(G):
+    """Return the connected components of G's undirected edges.
 
-    #unoriented_v_structures = list(iter_unoriented_v_structures(pdag))
-    # the dags that we've found
-    dags = []
-    # stack containing both edges that we have already oriented, and 
-    # the current pdag after those edges have been oriented
-    stack = [ [[(a,b),], orient_edge_and_propogate_changes(pdag, a, b)]
-              for a, b in get_undirected_edges(pdag) ]
-    stack = [(x, g) for x, g in stack if g != None]
-    while len(stack) > 0:
-        oriented_edges, curr_pdag = stack.pop()
-        edges_to_orient = get_undirected_edges(curr_pdag)
-        # if there are no more edges to orient, then make sure that we haven't 
-        # already seen it and that it is acyclic, and add it
-        if len(edges_to_orient) == 0: 
-            if (not any(set(curr_pdag.edges()) == set(x.edges()) for x in dags)
-                    and nx.is_directed_acyclic_graph(curr_pdag)):
-                #plot_pdag(curr_pdag, real_G)
-                dags.append(curr_pdag)
-        else:
-            for a, b in edges_to_orient:
-                new_pdag = orient_edge_and_propogate_changes(curr_pdag, a, b)
-                if new_pdag != None:
-                    stack.append([oriented_edges + [(a, b),], new_pdag])
-    
-    return dags
+    Only components with at least one undirected edge are returned, each as
+    a sorted list of nodes.
+    """
+    components = []
+    visited = set()
+    for node in G.nodes():
+        if node in visited: continue
+        if len(G.undirected_neighbors(node)) == 0: continue
+        component = []
+        visited.add(node)
+        pending = [node,]
+        while len(pending) > 0:
+            curr_node = pending.pop()
+            component.append(curr_node)
+            for neighbor in G.undirected_neighbors(curr_node):
+                if neighbor in visited: continue
+                visited.add(neighbor)
+                pending.append(neighbor)
+        components.append(sorted(component))
+    return components
+
+def orient_rooted_chain_component(nodes, adjacency, root):
+    """Orient every edge out of root, and propagate the IC rules.
+
+    nodes is a chain component (a frozenset of nodes) and adjacency maps 
+    each node to its undirected neighbors. Every DAG in the component's 
+    equivalence class has a single source, so the DAGs with source root are 
+    exactly the orientations of the returned chain components.
+
+    Returns the arcs (a, b) that were oriented, and the remaining chain 
+    components as frozensets.
+    """
+    node_list = sorted(nodes)
+    index = dict((node, i) for i, node in enumerate(node_list))
+    H = CompactGraph(node_list)
+    for node in node_list:
+        for neighbor in adjacency[node] & nodes:
+            if node < neighbor: H.add_edge(index[node], index[neighbor])
+    root = index[root]
+    for neighbor in list(H.succ[root]):
+        H.remove_arc(neighbor, root)
+    propagate_orientations(H)
+
+    arcs = [(node_list[a], node_list[b]) for a, b in H.arcs()
+            if a not in H.succ[b]]
+    components = [frozenset(node_list[x] for x in component)
+                  for component in find_chain_components(H)]
+    return arcs, components
+
+def count_chain_component_dags(nodes, adjacency, memo):
+    """Count the DAGs consistent with the chain component nodes.
+
+    Cliques have n! orientations and trees have n, otherwise this sums the 
+    number of orientations rooted at each node. Results are memoized by the 
+    component's node set.
+    """
+    if nodes in memo: return memo[nodes]
+    n_nodes = len(nodes)
+    n_edges = sum(len(adjacency[node] & nodes) for node in nodes)//2
+    if n_edges == n_nodes*(n_nodes-1)//2:
+        count = math.factorial(n_nodes)
+    elif n_edges == n_nodes-1:
+        count = n_nodes
+    else:
+        count = 0
+        for root in nodes:
+            arcs, components = orient_rooted_chain_component(
+                nodes, adjacency, root)
+            root_count = 1
+            for component in components:
+                root_count *= count_chain_component_dags(
+                    component, adjacency, memo)
+            count += root_count
+    memo[nodes] = count
+    return count
+
+def count_consistent_dags(pdag):
+    """Count the DAGs in pdag's equivalence class without building them.
+
+    This is the product of the counts of each chain component.
+    """
+    adjacency = [pdag.undirected_neighbors(node) for node in pdag.nodes()]
+    memo = {}
+    count = 1
+    for component in find_chain_components(pdag):
+        count *= count_chain_component_dags(
+            frozenset(component), adjacency, memo)
+    return count
+
+def iter_consistent_dags(pdag):
+    """Lazily iterate the DAGs in pdag's equivalence class.
+
+    The pdag is decomposed into its chain components, and each component's 
+    orientations are enumerated by choosing the source node and recursing on 
+    the chain components that remain after propagating the IC rules. Every 
+    DAG is built once, but the sha1 of each DAG's oriented arcs is kept to 
+    guarantee that no DAG is yielded twice.
+    """
+    adjacency = [pdag.undirected_neighbors(node) for node in pdag.nodes()]
+
+    def iter_component_orientations(nodes):
+        if len(nodes) == 1: 
+            yield []
+            return
+        for root in sorted(nodes):
+            arcs, components = orient_rooted_chain_component(
+                nodes, adjacency, root)
+            for sub_arcs in iter_orientations(components):
+                yield arcs + sub_arcs
+        return
 
+    def iter_orientations(components):
+        if len(components) == 0:
+            yield []
+            return
+        for arcs in iter_component_orientations(components[0]):
+            for other_arcs in iter_orientations(components[1:]):
+                yield arcs + other_arcs
+        return
+
+    seen_dags = set()
+    components = [frozenset(x) for x in find_chain_components(pdag)]
+    for arcs in iter_orientations(components):
+        key = hashlib.sha1(str(sorted(arcs))).digest()
+        if key in seen_dags: continue
+        seen_dags.add(key)
+        dag = pdag.copy()
+        for a, b in arcs:
+            dag.remove_arc(b, a)
+        # a pdag with conflicting v-structures isn't a valid CPDAG, so it
+        # can have orientations that introduce cycles
+        if not dag.is_acyclic(): continue
+        yield dag
+    return
+
+def find_all_consistent_dags(pdag, cond_independence_sets=None, real_G=None):
+    return list(iter_consistent_dags(pdag))
 
 def plot_pdag(pdag, real_G):
+    if isinstance(pdag, CompactGraph): pdag = pdag.to_networkx()
     real_G_layout = hierarchical_layout(real_G)
     #nx.draw(est_G, nx.graphviz_layout(est_G,prog='twopi',args=''))
     labels = dict((id, data['label']) for id, data in pdag.nodes(data=True))
@@ -752,26 +2809,85 @@ def plot_pdag(pdag, real_G):
     return
 
 
-def load_data():
-    samples = None
-    genes = []
-    expression = []
-    with open("all_quant.txt") as fp:
-        for i, line in enumerate(fp):
+def parse_expression_file(fname):
+    """Parse an expression file - a header line of sample names, and then a 
+    gene name followed by one value per sample on every line.
+
+    Returns the samples, the genes and the expression matrix.
+    """
+    genes, rows = [], []
+    with open(fname) as fp:
+        samples = fp.readline().split()[1:]
+        for line in fp:
             data = line.split()
-            if i == 0:
-               samples = data[1:]
-               continue
-            # append the gene name
-            gene_expression = numpy.array(map(float, data[1:]))
-            if numpy.max(gene_expression) < MIN_TPM: continue
             genes.append(data[0])
-            # add random normal noise to the gene expressionvalues to prevent 
-            # high correlation artifacts due to rounding error, etc. 
-            gene_expression += (numpy.random.randn(len(gene_expression)))**2
-            expression.append( gene_expression )
+            rows.append(data[1:])
+    expression = numpy.array(rows, dtype=float).reshape(len(genes), -1)
+    return samples, genes, expression
+
+def expression_cache_prefix(fname, min_tpm):
+    """Return the path prefix of fname's cache files.
+
+    The prefix includes a digest of fname's path, its modification time and
+    min_tpm, so editing the expression file, or changing the filter, builds
+    a new cache.
+    """
+    key = "%s\t%r\t%r" % (
+        os.path.abspath(fname), os.path.getmtime(fname), min_tpm)
+    return os.path.join(
+        EXPRESSION_CACHE_DIR, "%s.%s" % (
+            os.path.basename(fname), hashlib.sha1(key).hexdigest()[:16]))
+
+def write_expression_cache(fname, min_tpm):
+    """Parse fname, drop the genes whose maximum expression is below min_tpm 
+    (if min_tpm is not None), and write the cache files.
+
+    The expression matrix is written as a .npy file so that it can be 
+    memory mapped, and the labels are written to a small .npz. The matrix is
+    moved into place last, so a crash never leaves a partial cache.
+    """
+    samples, genes, expression = parse_expression_file(fname)
+    if min_tpm is not None:
+        # a nan max is kept, as in the row by row filter
+        keep = ~(expression.max(1) < min_tpm)
+        genes = [gene for gene, x in zip(genes, keep) if x]
+        expression = expression[keep]
     
-    expression = numpy.vstack(expression)
+    prefix = expression_cache_prefix(fname, min_tpm)
+    if not os.path.exists(EXPRESSION_CACHE_DIR):
+        os.makedirs(EXPRESSION_CACHE_DIR)
+    with open(prefix + ".labels.npz.tmp", "wb") as ofp:
+        numpy.savez(ofp, samples=numpy.array(samples), genes=numpy.array(genes))
+    os.rename(prefix + ".labels.npz.tmp", prefix + ".labels.npz")
+    with open(prefix + ".expression.npy.tmp", "wb") as ofp:
+        numpy.save(ofp, numpy.ascontiguousarray(expression))
+    os.rename(prefix + ".expression.npy.tmp", prefix + ".expression.npy")
+    return
+
+def load_expression_matrix(fname, min_tpm=MIN_TPM):
+    """Load the filtered expression matrix of fname from its binary cache. 
+
+    The cache is built on the first call (see write_expression_cache). 
+
+    Returns the samples, the genes, and the read only memory mapped 
+    expression matrix.
+    """
+    prefix = expression_cache_prefix(fname, min_tpm)
+    if not os.path.exists(prefix + ".expression.npy"):
+        write_expression_cache(fname, min_tpm)
+    with numpy.load(prefix + ".labels.npz") as labels:
+        samples = labels['samples'].tolist()
+        genes = labels['genes'].tolist()
+    expression = numpy.load(prefix + ".expression.npy", mmap_mode='r')
+    return samples, genes, expression
+
+def load_data():
+    samples, genes, expression = load_expression_matrix(
+        "all_quant.txt", MIN_TPM)
+    # add random normal noise to the gene expressionvalues to prevent 
+    # high correlation artifacts due to rounding error, etc. The noise is 
+    # drawn in row order, so it matches adding it one gene at a time
+    expression = expression + (numpy.random.randn(*expression.shape))**2
     s1 = expression[:,(3,0,5)]
     s2 = expression[:,(4,2,7)]
     return genes, s1, s2
@@ -779,7 +2895,7 @@ def load_data():
 def main():
     genes, sample1, sample2 = load_data()
     pdag, cond_independence_sets = estimate_pdag(sample1, sample2, genes)
-    nx.write_gml(pdag, "expression_GT_%i_pdag.gml" % MIN_TPM)
+    write_graph("expression_GT_%i_pdag.graph.npz" % MIN_TPM, pdag)
     print pdag
     return
 